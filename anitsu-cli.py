@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 from utils import *
 from sys import argv, exit
-from threading import Thread
-from shutil import which
+from shutil import which, rmtree
+from collections import OrderedDict
+from contextlib import ExitStack
+from functools import lru_cache
+from glob import glob
+from hashlib import sha1
 import xmlrpc.client
-import signal
-import json
 import subprocess as sp
+import asyncio
+import errno
+from downloader import Downloader, show_progress
 
 has_ueberzug = False
 try:
@@ -17,15 +22,36 @@ except ImportError:
     pass
 has_viu = which('viu')
 has_chafa = which('chafa')
+BACKEND = None if has_ueberzug else 'viu' if has_viu else \
+    'chafa' if has_chafa else None
+extracted = OrderedDict()  # images in IMG_TMP, oldest first
+rendered = OrderedDict()  # render key: viu/chafa output, oldest first
+rendering = dict()  # render key: task
+trees = dict()  # post id: Tree, loaded on demand
+owned = None  # {(name, size)} of the files in DL_DIR, see utils.scan_local
+engine = None  # built-in Downloader, used when the aria2 RPC is not running
+placement = None  # ueberzug image placement
+rpc = None  # aria2 RPC client
+submitted = dict()  # uri: gid sent to the aria2 RPC
 
 PID = os.getpid()
 SCRIPT = os.path.realpath(__file__)
 NAME = SCRIPT.split('/')[-1]
-FZF_PID = f'/tmp/anitsu.fzf.{PID}'
-DL_FILE = f'/tmp/anitsu.{PID}'
 FIFO = f'/tmp/anitsu.{PID}.fifo'
-PREVIEW_FIFO = f'/tmp/anitsu.preview.{PID}.fifo'
-UB_FIFO = f'/tmp/anitsu.ueberzug.{PID}.fifo'
+IMG_TMP = f'/tmp/anitsu.images.{PID}'  # thumbnails extracted from the pack
+
+
+def fzf_request(action: str, arg: str) -> str:
+    """ Shell command for a fzf binding. The fzf placeholders in `arg` are
+    written to "$f.in", a request line naming the response fifo "$f" goes to
+    FIFO (one short write, so concurrent requests never interleave) and the
+    response is read from "$f". No parentheses, fzf would end the action
+    argument there """
+    return (f'f=`mktemp -u {FIFO}.XXXXXX` && mkfifo "$f" && '
+            f'printf "%s\\n" {arg} > "$f.in" && '
+            f'printf "{action} %s\\n" "$f" > {FIFO} && cat "$f"; '
+            'rm -f "$f" "$f.in"')
+
 
 PROMPT = ''
 LABEL = '╢ ctrl-d ctrl-a ctrl-f ctrl-g ctrl-t ctrl-h ctrl-l ctrl-c ╟'
@@ -39,12 +65,12 @@ FZF_ARGS = [
     '--prompt', PROMPT,
     '--preview-window', 'left:52%:border-sharp',
     '--no-scrollbar',
-    '--preview', f"printf '%s' {{}} > {PREVIEW_FIFO} && cat {PREVIEW_FIFO}",
-    '--bind', f"enter:reload(printf '%s\\n' {{+}} > {FIFO} && cat {FIFO})+clear-query",
-    '--bind', f"ctrl-h:reload(printf ::.. > {FIFO} && cat {FIFO})+clear-query",
-    '--bind', f"ctrl-l:reload(printf '%s' {{}} > {FIFO} && cat {FIFO})+clear-query",
-    '--bind', f"ctrl-f:reload(printf 'files_only\\n' > {FIFO} && cat {FIFO})",
-    '--bind', f"ctrl-d:execute(printf '%s\\n' download_folder {{+}} > {FIFO}; cat {FIFO})+clear-selection",
+    '--preview', fzf_request('preview', '{}'),
+    '--bind', f"enter:reload({fzf_request('enter', '{+}')})+clear-query",
+    '--bind', f"ctrl-h:reload({fzf_request('enter', '::..')})+clear-query",
+    '--bind', f"ctrl-l:reload({fzf_request('enter', '{}')})+clear-query",
+    '--bind', f"ctrl-f:reload({fzf_request('files_only', '')})",
+    '--bind', f"ctrl-d:execute-silent({fzf_request('download_folder', '{+}')})+clear-selection",
     '--bind', 'ctrl-a:toggle-all',
     '--bind', 'ctrl-g:first',
     '--bind', 'ctrl-t:last',
@@ -53,18 +79,22 @@ FZF_ARGS = [
 ]
 WIDTH = 30  # preview width
 HEIGHT = 18
+MAX_IMG_TMP = 16
+RENDER_DIR = os.path.join(IMG_DIR, '.render')  # viu/chafa output
+MAX_RENDERED = 128  # rendered images kept in memory
+MAX_RENDER_FILES = 4096  # rendered images kept in RENDER_DIR
+RENDER_JOBS = 2  # viu/chafa processes at once
+PRERENDER = 3  # posts rendered ahead of the cursor
+OWNED = '✓ '  # prefix of the files and folders already in DL_DIR
 PORT = 6800  # RPC port
+ARIA2_BATCH = 100  # addUri calls per system.multicall
+MAX_WAITING = 10000  # waiting downloads checked for duplicates
 ARIA2_CONF = {  # RPC config
     'dir': DL_DIR,
     'force-save': 'false',
     'check-integrity': 'true',
     'max-concurrent-downloads': 2
 }
-ARIA2_ARGS = [
-    '-j', '2',
-    '--dir', DL_DIR,
-    f'--input-file={DL_FILE}'
-]
 
 
 def get_psize(size: int):
@@ -77,273 +107,487 @@ def get_psize(size: int):
     return psize
 
 
-def fzf(args):
+def prune_render():
+    """ Keep the MAX_RENDER_FILES images of RENDER_DIR used last """
     try:
-        proc = sp.Popen(
-            ["fzf"] + FZF_ARGS,
-            stdin=sp.PIPE, stdout=sp.PIPE,
-            universal_newlines=True
-        )
-        open(FZF_PID, 'w').write(str(proc.pid))
-        proc.communicate('\n'.join(args))
-    except KeyboardInterrupt:
-        pass
-    finally:
-        os.remove(FZF_PID)
-        cleanup()
+        files = [i for i in os.scandir(RENDER_DIR) if i.is_file()]
+    except FileNotFoundError:
+        return
+    files.sort(key=lambda i: i.stat().st_mtime, reverse=True)
+    for i in files[MAX_RENDER_FILES:]:
+        try:
+            os.remove(i.path)
+        except FileNotFoundError:
+            pass
 
 
-def kill_fzf():
-    if not os.path.exists(FZF_PID):
-        return
+def cleanup():
+    """ Delete the request fifos and temporary files """
+    rmtree(IMG_TMP, ignore_errors=True)
+    for i in glob(f'{FIFO}*'):
+        try:
+            os.remove(i)
+        except FileNotFoundError:
+            pass
 
-    try:
-        with open(FZF_PID, 'r') as f:
-            pid = int(f.read())
-        os.kill(pid, signal.SIGTERM)
-    except Exception:
-        pass
 
+def get_image(post_id: str):
+    """ Return a path to the post image, thumbnails that only exist in the
+    packed store are extracted to IMG_TMP (keeping the last MAX_IMG_TMP) """
+    img = os.path.join(IMG_DIR, f'{post_id}.jpg')
+    if os.path.exists(img):
+        return img
 
-def kill_fifo(fifo: str):
-    if not os.path.exists(fifo):
-        return
+    img = os.path.join(IMG_TMP, f'{post_id}.jpg')
+    if img in extracted:
+        extracted.move_to_end(img)
+        return img
 
-    with open(fifo, 'w') as fp:
-        fp.write('')
+    data = read_pack(post_id)
+    if data is None:
+        return None
 
-    try:
-        os.remove(fifo)
-    except FileNotFoundError:
-        pass
+    os.makedirs(IMG_TMP, exist_ok=True)
+    with open(img, 'wb') as fp:
+        fp.write(data)
+    extracted[img] = None
+    if len(extracted) > MAX_IMG_TMP:
+        os.remove(extracted.popitem(last=False)[0])
+    return img
 
 
-def cleanup():
-    """ Make sure that every FIFO dies and temporary files are deleted """
-    for i in [UB_FIFO, PREVIEW_FIFO, FIFO]:
-        t = Thread(target=kill_fifo, args=(i,))
-        t.start()
-        threads.append(t)
+def get_tree(post_id: str):
+    """ Load a post tree the first time it is needed """
+    if post_id not in trees:
+        trees[post_id] = load_tree(conn, post_id)
+    return trees[post_id]
 
 
-def ueberzug_fifo():
-    """ Ueberzug fifo listener """
+def resolve(key: str) -> tuple:
+    """ Keys are "post_id:index:name" so any key shown in fzf maps straight to
+    its (tree, index) without looking at the navigation state """
+    post_id, i, _ = key.split(':', 2)
+    return get_tree(post_id), int(i)
 
-    # https://github.com/b1337xyz/ueberzug#python
-    with ueberzug.Canvas() as canvas:
-        pv = canvas.create_placement(
-            'pv', x=0, y=0, width=WIDTH, height=HEIGHT,
-            scaler=ueberzug.ScalerOption.DISTORT.value
-        )
-        while os.path.exists(UB_FIFO):
-            with open(UB_FIFO, 'r') as fifo:
-                img = [i for i in fifo.read().split('\n') if i]
 
-            if len(img) == 0:
-                break
+async def run(*args) -> str:
+    """ Return the output of a command, killing it if cancelled """
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL)
+    try:
+        stdout, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    return stdout.decode()
 
-            pv.path = img[-1]
-            pv.visibility = ueberzug.Visibility.VISIBLE
 
+async def preview(key: str) -> str:
+    """ List files for fzf preview and send the post image to ueberzug """
+    if key is None:
+        return ''
+    elif key == '::..':  # show nothing
+        return 'go back'
 
-def preview(key: str, files: list):
-    """ List files and send to fzf preview and the post image to ueberzug """
-    post_id, size = key.split(':')[:2]
-    img = os.path.join(IMG_DIR, f'{post_id}.jpg')
+    tree, i = resolve(key)
     output = [] if not has_ueberzug else ['\n' * HEIGHT]
-    if os.path.exists(img):
-        if has_ueberzug:
-            with open(UB_FIFO, 'w') as ub_fifo:
-                ub_fifo.write(f'{img}\n')
-        elif has_viu:
-            output += [sp.run([
-                'viu', '-w', str(WIDTH), '-h', str(HEIGHT), img
-            ], stdout=sp.PIPE).stdout.decode()]
-        elif has_chafa:
-            output += [sp.run(['chafa', f'--size={WIDTH}x{HEIGHT}', img],
-                              stdout=sp.PIPE).stdout.decode()]
-
-    files = sorted(files, key=lambda x: ''.join(x.split(':')[2:]))
-    files = sorted(files, key=lambda x: int(x.split(':')[1]) > 0)  # dir first
-    total = 0
-    for i, v in enumerate(files):
-        filename = ':'.join(v.split(':')[2:])
-        _, size = v.split(':')[:2]
-        size = int(size)
-        total += size
-        if size > 0:
-            psize = get_psize(size)
-            files[i] = f'{psize} {MAG}{filename}{END}'
-        else:
-            files[i] = f'{BLU}{filename}{END}'
+    if has_ueberzug:
+        img = get_image(tree.post_id)
+        if img is not None:
+            placement.path = img
+            placement.visibility = ueberzug.Visibility.VISIBLE
+    elif BACKEND:
+        # started before the neighbours so it gets the first render job
+        image = asyncio.ensure_future(render(tree.post_id))
+        prerender(key)
+        image = await image
+        output += [image] if image else []
+
+    # children are stored directories first and sorted by name, and the size
+    # of a directory is the total of its files, see utils.Tree
+    files = []
+    for j in list(tree.children(i))[:80] if tree.is_dir(i) else [i]:
+        color = BLU if tree.is_dir(j) else MAG
+        files.append(f'{get_psize(tree.size[j])} {color}{tree.name[j]}{END}')
 
-    if total > 0:
-        psize = get_psize(total).strip()
-        output += [f'Total size: {psize}']
+    if engine is not None and engine.running:
+        output += [f'Downloading: {engine.status()}']
+    if tree.size[i] > 0:
+        psize = get_psize(tree.size[i]).strip()
+        output += [f'Total size: {psize} ({tree.count[i]} files)']
 
-    with open(PREVIEW_FIFO, 'w') as fifo:
-        fifo.write('\n'.join(output + files))
+    return '\n'.join(output + files)
 
 
-def preview_fifo():
-    """ Preview fifo listener """
-    while os.path.exists(PREVIEW_FIFO):
-        with open(PREVIEW_FIFO, 'r') as fifo:
-            data = [i for i in fifo.read().split('\n') if i]
+def render_key(post_id: str):
+    """ (image path, mtime, WIDTH, HEIGHT, BACKEND) as a string, None if the
+    post has no image. Packed thumbnails use the pack file """
+    img = os.path.join(IMG_DIR, f'{post_id}.jpg')
+    src = img if os.path.exists(img) else PACK_DATA
+    try:
+        mtime = os.stat(src).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return f'{src}:{post_id}:{mtime}:{WIDTH}:{HEIGHT}:{BACKEND}'
+
+
+async def render(post_id: str) -> str:
+    """ Return the viu/chafa output for the post image. Concurrent callers
+    share one render, which goes on when a stale preview is cancelled """
+    key = render_key(post_id)
+    if key is None:
+        return ''
+    if key in rendered:
+        rendered.move_to_end(key)
+        return rendered[key]
+    if key not in rendering:
+        rendering[key] = asyncio.create_task(render_image(key, post_id))
+        rendering[key].add_done_callback(lambda _: rendering.pop(key, None))
+    return await asyncio.shield(rendering[key])
+
+
+async def render_image(key: str, post_id: str) -> str:
+    """ Read the output from RENDER_DIR or run BACKEND and save it there """
+    file = os.path.join(RENDER_DIR, sha1(key.encode()).hexdigest())
+    try:
+        with open(file, 'r') as fp:
+            text = fp.read()
+        os.utime(file)  # the newest are kept by prune_render()
+    except FileNotFoundError:
+        img = get_image(post_id)
+        if img is None:
+            return ''
+        async with render_jobs:
+            if BACKEND == 'viu':
+                text = await run('viu', '-w', str(WIDTH), '-h', str(HEIGHT),
+                                 img)
+            else:
+                text = await run('chafa', f'--size={WIDTH}x{HEIGHT}', img)
+        os.makedirs(RENDER_DIR, exist_ok=True)
+        with open(f'{file}.{PID}', 'w') as fp:
+            fp.write(text)
+        os.replace(f'{file}.{PID}', file)
+
+    rendered[key] = text
+    if len(rendered) > MAX_RENDERED:
+        rendered.popitem(last=False)
+    return text
+
+
+def prerender(key: str):
+    """ Render in the background the images of the next PRERENDER posts
+    and the previous one in the current list """
+    global positions
+    if positions is None:
+        positions = {k: i for i, k in enumerate(output)}
+    i = positions.get(key)
+    if i is None:
+        return
 
-        if len(data) == 0:
-            return
+    post_id = key.split(':', 1)[0]
+    found = []
+    for lines, n in [(output[i + 1:i + 1000], PRERENDER),
+                     (output[max(0, i - 1000):i][::-1], 1)]:
+        posts = []
+        for k in lines:
+            k = k.split(':', 1)[0]
+            if not k:  # the '::..' line back out of a folder
+                continue
+            if k != post_id and k not in posts and k not in found:
+                posts.append(k)
+                if len(posts) == n:
+                    break
+        found += posts
 
-        k = data[-1]
-        if k == '::..':  # show nothing
-            open(PREVIEW_FIFO, 'w').write('go back')
-            continue
-        elif isinstance(db[k], dict):  # is a directory
-            output = [i for i in db[k]]
-        else:  # is a file
-            output = [k]
+    for k in found:
+        task = asyncio.create_task(render(k))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
 
-        preview(k, output[:80])
 
+def is_dir(key: str) -> bool:
+    tree, i = resolve(key)
+    return tree.is_dir(i)
 
-def find_files(data) -> list:
-    """ Recursively find "files" and return there values """
-    if isinstance(data, str):
-        return [data]
 
-    files = []
-    for k in data:
-        files += find_files(data[k]) if isinstance(data[k], dict) else [data[k]]
-    return files
+def find_files(key: str) -> list:
+    """ Return the links of every file under a key not downloaded yet """
+    tree, i = resolve(key)
+    return [tree.link(j) for j in tree.files(i)
+            if (tree.name[j], tree.size[j]) not in owned]
 
 
-def files_only(d: dict) -> dict:
-    """ Recursively find "files" and return them as {key: value, ...} """
-    out = dict()
-    for k in d:
-        if isinstance(d[k], dict):
-            out.update(files_only(d[k]))
-        else:
-            out[k] = d[k]
-    return out
+def refresh_owned():
+    """ Update `owned` from DL_DIR, the listings are made again if it
+    changed so their marks are up to date """
+    global owned
+    if scan_local(conn) or owned is None:
+        owned = load_local(conn)
+        listing.cache_clear()
 
 
-def download(files: list):
-    session = xmlrpc.client.ServerProxy(f'http://localhost:{PORT}/rpc')
-    try:
-        for uri in files:
-            session.aria2.addUri([uri], ARIA2_CONF)
-        return
-    except ConnectionRefusedError:
-        pass
+def line(tree, i: int) -> str:
+    """ fzf line of node `i`, marked if all of its files are owned """
+    files = tree.files(i)
+    if files and all((tree.name[j], tree.size[j]) in owned for j in files):
+        return f'{tree.post_id}:{i}:{OWNED}{tree.name[i]}'
+    return tree.key(i)
 
-    # TODO: stop fzf and resume instead
-    os.remove(FIFO)
-    kill_fzf()
 
-    with open(DL_FILE, 'w') as fp:
-        fp.write('\n'.join(files))
+@lru_cache(maxsize=64)
+def listing(key, only_files: bool) -> tuple:
+    """ Return the fzf lines under `key` (None for the top level), memoized
+    so going back or toggling files only is a lookup """
+    if key is None and not only_files:
+        return tuple(titles)
 
-    # pid = int(open(FZF_PID, 'r').read())
-    # os.kill(pid, signal.SIGTSTP)
-    # os.system('clear')
+    nodes = [resolve(k) for k in titles] if key is None else [resolve(key)]
+    if only_files:  # a slice of Tree.fidx, see utils.Tree
+        return tuple(line(tree, j) for tree, i in nodes for j in tree.files(i))
+    return tuple(line(tree, j) for tree, i in nodes for j in tree.children(i))
 
-    try:
-        p = sp.run(['aria2c'] + ARIA2_ARGS)
-        if p.returncode == 0:
-            os.remove(DL_FILE)
-    except KeyboardInterrupt:
-        pass
-    # finally:
-    #     os.kill(pid, signal.SIGCONT)
 
+def add_uris(files: list):
+    """ Send files to the aria2 RPC in system.multicall batches of
+    ARIA2_BATCH, skipping the ones it already has active or waiting.
+    Returns {uri: gid} of the new downloads, None if it is not running """
+    global rpc
+    if rpc is None:  # one connection kept alive for the whole session
+        rpc = xmlrpc.client.ServerProxy(f'http://localhost:{PORT}/rpc')
 
-def fzf_reload(keys: list):
-    """ Handles fzf reload() """
+    try:
+        queued = rpc.system.multicall([
+            {'methodName': 'aria2.tellActive', 'params': [['files']]},
+            {'methodName': 'aria2.tellWaiting',
+             'params': [0, MAX_WAITING, ['files']]}
+        ])
+    except ConnectionRefusedError:
+        return None
+
+    known = {u['uri'] for r in queued if isinstance(r, list)
+             for i in r[0] for f in i['files'] for u in f['uris']}
+    files = [i for i in dict.fromkeys(files) if i not in known]
+    gids = dict()
+    for n in range(0, len(files), ARIA2_BATCH):
+        batch = files[n:n + ARIA2_BATCH]
+        results = rpc.system.multicall([
+            {'methodName': 'aria2.addUri', 'params': [[uri], ARIA2_CONF]}
+            for uri in batch
+        ])
+        for uri, r in zip(batch, results):
+            if isinstance(r, list):  # faults come back as a dict
+                gids[uri] = r[0]
+    return gids
+
+
+async def download(files: list):
+    # xmlrpc blocks, run it off the loop one call at a time
+    async with rpc_lock:
+        gids = await asyncio.to_thread(add_uris, files)
+    if gids is not None:
+        submitted.update(gids)
+        return
 
-    # preview_fifo() needs to access changes in `db`
-    global db
+    # no RPC, download in the background, fzf stays open
+    for uri in files:
+        engine.add(uri)
 
+
+def navigate(action: str, data: list) -> list:
+    """ Update the navigation state, returns the new list or None to keep
+    the current one """
     back = '::..'
-    old_db = []
-    files_only_on = False
-    output = keys
-    while os.path.exists(FIFO):
-        with open(FIFO, 'r') as fifo:
-            data = [i for i in fifo.read().split('\n') if i]
-
-        if len(data) == 0:
-            break
+    files = []
+    chosen = action == 'download_folder'  # files picked, the list stays
+    refresh_owned()
+    if chosen:
+        for k in data:
+            files += find_files(k) if k != back else []
+    elif action == 'files_only':
+        key, only = path[-1]
+        path[-1] = (key, not only)
+    else:
+        for k in data:
+            if k == back:
+                if len(data) == 1 and len(path) > 1:
+                    path.pop()
+            elif not is_dir(k):
+                chosen = True
+                files += find_files(k)
 
-        files = []
-        if 'download_folder' in data:
-            for k in data[1:]:
-                files += find_files(db[k])
-            download(files)
-        elif 'files_only' in data:
-            if files_only_on:
-                db = old_db[-1].copy()
-            else:
-                old_db += [db.copy()]
-                db = files_only(db)
-            files_only_on = not files_only_on
-            output = list(db)
-        else:
-            for k in data:
-                if k == back and len(data) == 1:
-                    if len(old_db) > 0:
-                        db = old_db[-1].copy()
-                        del old_db[-1]
-                    break
-                elif k in db and not isinstance(db[k], dict):
-                    files.append(db[k])
-
-            if files:
-                download(files)
-            elif k in db:
-                output = [i for i in db[k]]
-                old_db += [db.copy()]
-                db = db[k].copy()
-            else:
-                output = list(db)
+        if not chosen and data and data[-1] != back:
+            path.append((data[-1], False))
 
-            output += [back] if old_db and back not in output else []
+    if files:
+        task = asyncio.create_task(download(files))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if chosen:
+        return None
 
-        if not os.path.exists(FIFO):
-            break
+    output = list(listing(*path[-1]))
+    return output + [back] if len(path) > 1 else output
 
-        with open(FIFO, 'w') as fifo:
-            fifo.write('\n'.join(output))
 
+def wake(future):
+    if not future.done():
+        future.set_result(None)
 
-def main():
-    global db, threads
-    with open(FILES_DB, 'r') as fp:
-        db = json.load(fp)
-    keys = sorted(db)
 
-    for i in [FIFO, PREVIEW_FIFO]:
-        os.mkfifo(i)
+async def reload(action: str, data: list) -> str:
+    """ Handles fzf reload() """
+    global output, positions
+    output = navigate(action, data) or output
+    positions = None
+    return '\n'.join(output) if action != 'download_folder' else ''
+
+
+async def write_fifo(fifo: str, data: str):
+    """ Write a response to the fifo of a request. Its reader, the `cat` of
+    fzf_request(), may not have opened it yet or may be gone already since
+    fzf kills stale previews """
+    loop = asyncio.get_running_loop()
+    for _ in range(100):
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except FileNotFoundError:
+            return
+        except OSError as err:
+            if err.errno != errno.ENXIO:  # ENXIO: no reader yet
+                raise
+            await asyncio.sleep(.01)
+    else:
+        return
 
-    if has_ueberzug:
-        os.mkfifo(UB_FIFO)
-        t = Thread(target=ueberzug_fifo)
-        t.start()
-        threads.append(t)
+    view = memoryview(data.encode())
+    try:
+        while view:
+            try:
+                view = view[os.write(fd, view):]
+            except BlockingIOError:
+                ready = loop.create_future()
+                loop.add_writer(fd, wake, ready)
+                try:
+                    await ready
+                finally:
+                    loop.remove_writer(fd)
+    except BrokenPipeError:
+        pass
+    finally:
+        os.close(fd)
 
-    t = Thread(target=preview_fifo)
-    t.start()
-    threads.append(t)
 
-    t = Thread(target=fzf, args=(keys,))
-    t.start()
-    threads.append(t)
+async def respond(fifo: str, func, *args):
+    """ Answer a request with the result of `func`, an empty response is
+    still sent if it is cancelled so no `cat` is left waiting """
+    text = ''
+    try:
+        text = await func(*args)
+    finally:
+        await asyncio.shield(write_fifo(fifo, text or ''))
+        try:
+            os.remove(fifo)
+        except FileNotFoundError:
+            pass
 
-    fzf_reload(keys)
+
+async def serve(reader):
+    """ Handle the requests sent by fzf_request(), a new preview cancels the
+    one still running since the cursor has moved on already """
+    previewing = None
+    while line := await reader.readline():
+        action, _, fifo = line.decode().rstrip('\n').partition(' ')
+        try:
+            with open(f'{fifo}.in', 'r') as fp:
+                data = [i for i in fp.read().split('\n') if i]
+            os.remove(f'{fifo}.in')
+        except FileNotFoundError:
+            continue
+
+        if action == 'preview':
+            if previewing is not None:
+                previewing.cancel()
+            previewing = asyncio.create_task(
+                respond(fifo, preview, data[-1] if data else None))
+            task = previewing
+        else:
+            task = asyncio.create_task(respond(fifo, reload, action, data))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+async def main():
+    global titles, conn, path, output, positions, tasks, fzf_proc, placement
+    global render_jobs, rpc_lock, engine
+    # only titles are read here, each post tree is loaded by get_tree() once
+    # it is previewed or entered
+    conn = open_db()
+    titles = [f'{k}:0:{title}' for k, title in load_titles(conn)]
+    refresh_owned()
+    # a stack of (key, files only) views, the top level key being None,
+    # entering a folder pushes and going back pops
+    path = [(None, False)]
+    output = titles
+    positions = None  # {line: index} of output, built by prerender()
+    tasks = set()
+    render_jobs = asyncio.Semaphore(RENDER_JOBS)
+    rpc_lock = asyncio.Lock()
+    prune_render()
+
+    # opened for reading and writing, so it never reaches EOF when the
+    # writers of the requests close it
+    os.mkfifo(FIFO)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader),
+        os.fdopen(os.open(FIFO, os.O_RDWR | os.O_NONBLOCK), 'rb', 0))
+
+    async with Downloader(DL_DIR) as engine:
+        with ExitStack() as stack:
+            if has_ueberzug:
+                # https://github.com/b1337xyz/ueberzug#python
+                canvas = stack.enter_context(ueberzug.Canvas())
+                placement = canvas.create_placement(
+                    'pv', x=0, y=0, width=WIDTH, height=HEIGHT,
+                    scaler=ueberzug.ScalerOption.DISTORT.value
+                )
+
+            fzf_proc = await asyncio.create_subprocess_exec(
+                'fzf', *FZF_ARGS, stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL)
+            server = asyncio.create_task(serve(reader))
+            try:
+                fzf_proc.stdin.write('\n'.join(titles).encode())
+                await fzf_proc.stdin.drain()
+                fzf_proc.stdin.close()
+                await fzf_proc.wait()
+            finally:
+                server.cancel()
+                for task in list(tasks):
+                    task.cancel()
+                if fzf_proc.returncode is None:
+                    fzf_proc.terminate()
+
+        if engine.running:  # ctrl-c leaves .part files to resume from
+            print('Waiting for downloads, ctrl-c to stop')
+            await asyncio.gather(engine.wait(), show_progress(engine))
+        for uri in engine.failed:
+            print(f'failed: {uri}')
 
 
 def update(args):
     os.chdir(ROOT)
+    images = '-i' in args or '--download-images' in args
+    if '--pipeline' in args:
+        import pipeline  # get_files.py looks for the rclone remote on import
+        code = asyncio.run(pipeline.main(images))
+        if code != 0:
+            exit(code)
+        return
+
     for script in ['get_posts.py', 'get_files.py']:
         print(f'>>> Running {script}')
         p = sp.run(['python3', script])
@@ -351,27 +595,29 @@ def update(args):
             exit(p.returncode)
         print()
 
-    if '-i' in args or '--download-images' in args:
-        sp.run(['python3', 'download_images.py'])
+    if images:
+        pack = ['--pack'] if '--pack' in args else []
+        sp.run(['python3', 'download_images.py'] + pack)
 
 
 if __name__ == '__main__':
     args = argv[1:]
     if not args:
-        if not os.path.exists(FILES_DB):
-            print(f'{FILES_DB} not found, creating it...')
+        if not has_files(open_db()):
+            print(f'{SQLITE_DB} is empty, creating it...')
             update(args)
 
-        threads = []
         try:
-            main()
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
         finally:
-            for i in threads:
-                if i.is_alive():
-                    print(f'waiting for {i.name} ...')
-                    i.join()
+            cleanup()
             print('bye ^-^')
     elif 'update' in args:
         update(args)
+    elif 'export' in args:
+        export_json(open_db())
+        print(f'Saved: {DB}\nSaved: {FILES_DB}')
     else:
-        print(f'Usage: {NAME} [update -i --download-images]')
+        print(f'Usage: {NAME} [update -i --download-images --pack --pipeline | export]')
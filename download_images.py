@@ -1,64 +1,301 @@
 #!/usr/bin/env python3
 from utils import *
 from aiohttp import ClientSession
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from shutil import copyfile
+from sys import argv
 import aiofiles
 import asyncio
-import json
+import hashlib
 import subprocess as sp
 
-Q_SIZE = 15
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+CACHE_DIR = os.path.join(IMG_DIR, '.cache')  # one thumbnail per image hash
+THUMB_SIZE = (424, 600)
+CHUNK_SIZE = 64 * 1024
+RESIZE_JOBS = os.cpu_count() or 1
+PACK = '--pack' in argv  # keep thumbnails in PACK_DATA instead of IMG_DIR
 counter = 0
+packed = dict()  # image hash: (offset, length) in PACK_DATA
+
+
+def resize(src: str, dst: str) -> bool:
+    """ Shrink the first frame of `src` to fit THUMB_SIZE and save it as
+    a jpeg at `dst`, runs in the process pool """
+    # written aside, an interrupted save must not look like a thumbnail
+    tmp = f'{dst}.tmp'
+    try:
+        if HAS_PIL:
+            with Image.open(src) as img:
+                img.seek(0)
+                img = img.convert('RGB')
+                img.thumbnail(THUMB_SIZE)
+                img.save(tmp, 'JPEG', quality=90)
+        else:
+            sp.run(['convert', f'{src}[0]', '-resize',
+                    '{}x{}>'.format(*THUMB_SIZE), f'jpg:{tmp}'], check=True)
+        os.replace(tmp, dst)
+        return True
+    except Exception:
+        return False
+    finally:
+        os.remove(src)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
 
+def thumb_exists(digest: str) -> bool:
+    return digest in packed or \
+        os.path.exists(os.path.join(CACHE_DIR, f'{digest}.jpg'))
 
-async def download(queue):
+
+def link(src: str, paths: list):
+    """ Make every post image in `paths` a hardlink of the thumbnail `src` """
+    if PACK:  # posts point at the thumbnail through PACK_INDEX
+        return
+    for dst in paths:
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            continue
+        tmp = f'{dst}.tmp'
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            os.link(src, tmp)
+        except OSError:
+            copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+
+def progress():
     global counter
+    counter += 1
+    pbar(counter, qsize)
+
+
+async def download(queue, resize_queue):
     while True:
-        url, image_path = await queue.get()
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                f = await aiofiles.open(image_path, mode='wb')
-                await f.write(await resp.read())
-                await f.close()
-            else:
-                print(f'error: {resp.status}, {url}')
-
-        if os.path.exists(image_path):
-            try:
-                sp.run([
-                    'convert', f'{image_path}[0]',
-                    '-resize', '424x600>', image_path
-                ])
-            except Exception:
-                os.remove(image_path)
-
-        counter += 1
-        pbar(counter, qsize)
+        url, paths, cached = await queue.get()
+        headers = dict()
+        if cached:
+            etag, last_modified, digest, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        tmp = f'{paths[0]}.part'
+        try:
+            async with request(session, 'GET', url, headers=headers) as resp:
+                if resp.status == 304:
+                    link(os.path.join(CACHE_DIR, f'{digest}.jpg'), paths)
+                    save_image(conn, url, etag, last_modified, digest)
+                    progress()
+                elif resp.status == 200:
+                    sha1 = hashlib.sha1()
+                    async with aiofiles.open(tmp, mode='wb') as f:
+                        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                            sha1.update(chunk)
+                            await f.write(chunk)
+                    await resize_queue.put((tmp, sha1.hexdigest(), url, paths,
+                                            resp.headers.get('ETag'),
+                                            resp.headers.get('Last-Modified')))
+                else:
+                    print(f'error: {resp.status}, {url}')
+                    progress()
+        except Exception as err:
+            print(f'error: {err}, {url}')
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            progress()
         queue.task_done()
 
 
+async def convert(resize_queue, pool):
+    loop = asyncio.get_running_loop()
+    while True:
+        tmp, digest, url, paths, etag, last_modified = await resize_queue.get()
+        thumb = os.path.join(CACHE_DIR, f'{digest}.jpg')
+        if thumb_exists(digest):  # same image behind another url
+            os.remove(tmp)
+            ok = True
+        else:
+            ok = await loop.run_in_executor(pool, resize, tmp, thumb)
+
+        if ok:
+            link(thumb, paths)
+            save_image(conn, url, etag, last_modified, digest)
+        else:
+            print(f'error: could not convert {url}')
+        progress()
+        resize_queue.task_done()
+
+
+def clean_cache():
+    """ Remove thumbnails no url points to anymore """
+    used = {f'{i}.jpg' for i, in conn.execute('SELECT hash FROM images')}
+    for i in os.listdir(CACHE_DIR):
+        if i not in used:
+            os.remove(os.path.join(CACHE_DIR, i))
+
+
+def write_pack():
+    """ Move new thumbnails from CACHE_DIR to the end of PACK_DATA, compact
+    it when most of it is dead and rewrite PACK_INDEX. Post images that
+    the index covers are removed from IMG_DIR """
+    new = os.listdir(CACHE_DIR)
+    with open(PACK_DATA, 'ab') as fp:
+        for i in new:
+            digest = i.split('.')[0]
+            if digest in packed:
+                continue
+            with open(os.path.join(CACHE_DIR, i), 'rb') as f:
+                data = f.read()
+            packed[digest] = (fp.tell(), len(data))
+            fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    rows = conn.execute('''SELECT p.id, p.image, i.hash FROM posts p
+                           JOIN images i ON i.url = p.image_url''').fetchall()
+    used = {i for _, _, i in rows if i in packed}
+    live = sum(packed[i][1] for i in used)
+    if os.path.getsize(PACK_DATA) > live * 2:
+        tmp = f'{PACK_DATA}.tmp'
+        with open(PACK_DATA, 'rb') as src, open(tmp, 'wb') as dst:
+            for i in used:
+                offset, length = packed[i]
+                src.seek(offset)
+                packed[i] = (dst.tell(), length)
+                dst.write(src.read(length))
+        for i in set(packed) - used:
+            del packed[i]
+        os.replace(tmp, PACK_DATA)
+    save_pack(conn, packed)
+    for i in new:
+        os.remove(os.path.join(CACHE_DIR, i))
+
+    records = sorted((int(k), *packed[i]) for k, _, i in rows if i in packed)
+    tmp = f'{PACK_INDEX}.tmp'
+    with open(tmp, 'wb') as fp:
+        for i in records:
+            fp.write(PACK_RECORD.pack(*i))
+    os.replace(tmp, PACK_INDEX)
+
+    for _, image_path, i in rows:
+        if i in packed and os.path.exists(image_path):
+            os.remove(image_path)
+
+
+def job(url: str, posts: list, cached):
+    """ Return the queue item of an image url used by `posts`, a list of
+    (image path, modified), or None if its thumbnail is up to date, in which
+    case the posts are linked to it """
+    paths = [i for i, _ in posts]
+    if cached is None:
+        if not all(os.path.exists(i) for i in paths):
+            return (url, paths, None)
+        return None
+
+    thumb = os.path.join(CACHE_DIR, f'{cached[2]}.jpg')
+    if not thumb_exists(cached[2]):
+        return (url, paths, None)
+    elif max(i for _, i in posts) > cached[3]:
+        # a post using it changed since the last check, the cover
+        # may have changed too
+        return (url, paths, cached)
+    link(thumb, paths)
+    return None
+
+
+async def stream(posts: asyncio.Queue):
+    """ Pipeline stage, download the image of every post id taken from
+    `posts` until a None. main() runs afterwards to link the posts that
+    share an image and to write the pack """
+    global session, qsize, conn, packed, counter
+    conn = open_db()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    packed = load_pack(conn) if PACK else dict()
+    images = load_images(conn)
+    seen = set()
+    qsize = 0
+
+    async def feed(queue):
+        global qsize
+        while True:
+            k = await posts.get()
+            if k is None:
+                return
+            url, path, modified = conn.execute(
+                'SELECT image_url, image, modified FROM posts WHERE id = ?',
+                (k,)).fetchone()
+            if not url or url in seen:
+                continue
+            seen.add(url)
+            item = job(url, [(path, modified)], images.get(url))
+            if item is not None:
+                qsize += 1
+                await queue.put(item)
+
+    async with ClientSession() as session:
+        queue = asyncio.Queue(MAX_INFLIGHT * 2)
+        await download_all(queue, feed(queue))
+
+    counter = 0
+    await main()
+
+
 async def main():
-    global session, qsize
+    global session, qsize, conn, packed
 
-    with open(DB, 'r') as fp:
-        db = json.load(fp)
+    conn = open_db()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    packed = load_pack(conn) if PACK else dict()
+    images = load_images(conn)
+    posts = defaultdict(list)  # every post sharing an image url
+    for url, image_path, modified in conn.execute(
+            'SELECT image_url, image, modified FROM posts'):
+        if url:
+            posts[url].append((image_path, modified))
 
     async with ClientSession() as session:
         queue = asyncio.Queue()
-        for k in db:
-            image_path = db[k]['image']
-            if not os.path.exists(image_path):
-                url = db[k]['image_url']
-                queue.put_nowait((url, image_path))
+        for url, v in posts.items():
+            item = job(url, v, images.get(url))
+            if item is not None:
+                queue.put_nowait(item)
 
         qsize = queue.qsize()
-        if qsize == 0:
-            return
-        print(f'{qsize} images to download, please wait...')
-        pbar(counter, qsize)
+        if qsize > 0:
+            print(f'{qsize} images to download, please wait...')
+            pbar(counter, qsize)
+            await download_all(queue)
+
+    clean_cache()
+    if PACK:
+        write_pack()
+
+
+async def download_all(queue, feed=None):
+    """ Download and resize the items of `queue`, if given the `feed`
+    coroutine keeps putting items in it until it returns """
+    # bounded so downloads wait for the resizers instead of filling the disk
+    resize_queue = asyncio.Queue(RESIZE_JOBS * 2)
+    with ProcessPoolExecutor(RESIZE_JOBS) as pool:
         tasks = []
-        for _ in range(Q_SIZE):
-            tasks += [asyncio.create_task(download(queue))]
+        for _ in range(MAX_INFLIGHT):
+            tasks += [asyncio.create_task(download(queue, resize_queue))]
+        for _ in range(RESIZE_JOBS):
+            tasks += [asyncio.create_task(convert(resize_queue, pool))]
+        if feed is not None:
+            await feed
         await queue.join()
+        await resize_queue.join()
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
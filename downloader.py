@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+""" Segmented HTTP downloader, the built-in alternative to aria2 """
+from aiohttp import ClientSession, ClientTimeout
+from aiohttp.client_exceptions import ClientError, ClientResponseError
+from collections import defaultdict
+from urllib.parse import unquote, urlsplit
+from sys import argv, exit
+import itertools
+import asyncio
+import json
+import time
+import os
+
+SEGMENTS = 4  # connections per file
+MIN_SEGMENT = 8 * 1024 * 1024  # files are not split in smaller parts
+MAX_FILES = 2  # files downloaded at once, like aria2c -j 2
+MAX_CONNECTIONS = 16
+MAX_PER_HOST = 4
+CHUNK = 1024 * 1024
+SAVE_EVERY = 16 * 1024 * 1024  # bytes written between control file saves
+RETRIES = 5
+
+
+class Downloader:
+    """ Download files into `dest` with HTTP Range segments.
+
+    A file is written to "name.part", preallocated to its full size, next
+    to "name.part.json" holding the segments and how far each one got, so
+    an interrupted download resumes where it stopped. Servers that ignore
+    Range get a single stream. `connections` and `per_host` cap the open
+    requests of every file together. """
+
+    def __init__(self, dest: str, files=MAX_FILES, connections=MAX_CONNECTIONS,
+                 per_host=MAX_PER_HOST, segments=SEGMENTS):
+        self.dest = dest
+        self.segments = segments
+        self.files = asyncio.Semaphore(files)
+        self.connections = asyncio.Semaphore(connections)
+        self.hosts = defaultdict(lambda: asyncio.Semaphore(per_host))
+        self.session = None
+        self.running = dict()  # url: task
+        self.paths = dict()  # path: url, every name taken in this session
+        self.progress = dict()  # url: [bytes done, size]
+        self.done = []
+        self.failed = []
+
+    async def __aenter__(self):
+        os.makedirs(self.dest, exist_ok=True)  # aria2 made it on its own
+        self.session = ClientSession(timeout=ClientTimeout(sock_read=60))
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    def add(self, url: str):
+        """ Start downloading `url` in the background unless it already is """
+        if url not in self.running:
+            self.running[url] = asyncio.create_task(self.download(url))
+        return self.running[url]
+
+    async def wait(self):
+        while self.running:
+            await asyncio.gather(*self.running.values(),
+                                 return_exceptions=True)
+
+    def status(self) -> str:
+        done = sum(i for i, _ in self.progress.values())
+        size = sum(i for _, i in self.progress.values())
+        pct = done * 100 // size if size else 0
+        return (f'{len(self.done)}/{len(self.done) + len(self.running)} '
+                f'files, {done / 1e6:.1f}/{size / 1e6:.1f} MB ({pct}%)')
+
+    async def download(self, url: str):
+        """ Return the path of the downloaded file or None """
+        try:
+            async with self.files:
+                for retry in range(RETRIES):
+                    try:
+                        path = await self.fetch(url)
+                        self.done.append(path)
+                        return path
+                    except ClientResponseError as err:
+                        if 400 <= err.status < 500 and err.status != 429:
+                            break
+                        await asyncio.sleep(2 ** retry)
+                    except (ClientError, asyncio.TimeoutError, OSError):
+                        await asyncio.sleep(2 ** retry)
+                    except (KeyError, ValueError):  # bad Content-Range
+                        break
+            self.failed.append(url)
+        finally:
+            self.running.pop(url, None)
+
+    async def slot(self, url: str):
+        """ Take a connection from the per host and global caps, in this order
+        so requests waiting on a busy host don't hold global ones """
+        await self.hosts[urlsplit(url).hostname].acquire()
+        await self.connections.acquire()
+
+    def release(self, url: str):
+        self.connections.release()
+        self.hosts[urlsplit(url).hostname].release()
+
+    async def fetch(self, url: str) -> str:
+        await self.slot(url)
+        try:
+            async with self.session.get(
+                    url, headers={'Range': 'bytes=0-0'}) as r:
+                r.raise_for_status()
+                name = r.content_disposition and r.content_disposition.filename
+                name = os.path.basename(
+                    name or unquote(r.url.path.rstrip('/'))).strip()
+                path = os.path.join(self.dest, name or 'download')
+                if r.status == 206:
+                    size = int(r.headers['Content-Range'].split('/')[-1])
+                    # r.url has no credentials, it only matters if redirected
+                    target = str(r.url) if r.history else url
+                    path = self.claim(url, path, size)
+                else:  # no Range support, this response is the file
+                    size = r.content_length
+                    path = self.claim(url, path, size)
+                    if self.complete(path, size):
+                        return path
+                    self.progress[url] = [0, size or 0]
+                    await self.stream(r, path, url)
+                    return path
+        finally:
+            self.release(url)
+
+        if self.complete(path, size):
+            return path
+        await self.segmented(url, target, path, size)
+        return path
+
+    def claim(self, url: str, path: str, size) -> str:
+        """ Return `path` for the download of `url` unless another one of
+        this session took it or it is a different file (its size or the
+        size of its .part differs), then "name.1.ext", "name.2.ext"... like
+        aria2 --auto-file-renaming """
+        base, ext = os.path.splitext(path)
+        for n in itertools.count():
+            name = f'{base}.{n}{ext}' if n else path
+            if self.paths.get(name, url) != url:
+                continue
+            try:
+                with open(f'{name}.part.json', 'r') as fp:
+                    if json.load(fp)['size'] != size:
+                        continue
+            except (FileNotFoundError, ValueError, KeyError):
+                if os.path.exists(name) and not self.complete(name, size):
+                    continue
+            self.paths[name] = url
+            return name
+
+    def complete(self, path: str, size) -> bool:
+        return size is not None and os.path.exists(path) and \
+            os.path.getsize(path) == size
+
+    async def stream(self, r, path: str, url: str):
+        """ Write a whole response, starting over every time """
+        with open(f'{path}.part', 'wb') as fp:
+            async for chunk in r.content.iter_chunked(CHUNK):
+                fp.write(chunk)
+                self.progress[url][0] += len(chunk)
+        os.replace(f'{path}.part', path)
+
+    async def segmented(self, url: str, target: str, path: str, size: int):
+        part, ctl = f'{path}.part', f'{path}.part.json'
+        if size == 0:
+            open(path, 'wb').close()
+            return
+
+        segments = None
+        try:
+            with open(ctl, 'r') as fp:
+                state = json.load(fp)
+            if state['size'] == size and os.path.exists(part):
+                segments = state['segments']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        if segments is None:
+            n = max(1, min(self.segments, size // MIN_SEGMENT))
+            step = -(-size // n)
+            segments = [[i, min(i + step, size), i]
+                        for i in range(0, size, step)]
+
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except (AttributeError, OSError):  # not on every system/fs
+                    os.ftruncate(fd, size)
+
+            self.progress[url] = [sum(p - s for s, _, p in segments), size]
+            unsaved = 0
+
+            def save():
+                nonlocal unsaved
+                unsaved = 0
+                with open(f'{ctl}.tmp', 'w') as fp:
+                    json.dump({'size': size, 'segments': segments}, fp)
+                os.replace(f'{ctl}.tmp', ctl)
+
+            async def get(seg: list):
+                nonlocal unsaved
+                _, end, _ = seg
+                while seg[2] < end:
+                    await self.slot(target)
+                    try:
+                        headers = {'Range': f'bytes={seg[2]}-{end - 1}'}
+                        async with self.session.get(target,
+                                                    headers=headers) as r:
+                            if r.status != 206:
+                                raise ClientError(f'{r.status} {target}')
+                            async for chunk in r.content.iter_chunked(CHUNK):
+                                chunk = chunk[:end - seg[2]]
+                                if not chunk:
+                                    break
+                                os.pwrite(fd, chunk, seg[2])
+                                seg[2] += len(chunk)
+                                self.progress[url][0] += len(chunk)
+                                unsaved += len(chunk)
+                                if unsaved >= SAVE_EVERY:
+                                    save()
+                    finally:
+                        self.release(target)
+
+            save()
+            tasks = [asyncio.create_task(get(i))
+                     for i in segments if i[2] < i[1]]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # a failed segment stops the others before fd is closed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                save()
+        finally:
+            os.close(fd)
+
+        os.replace(part, path)
+        os.remove(ctl)
+
+
+async def show_progress(dl: Downloader, interval=.5):
+    """ Print the status of `dl` on one line until it has nothing running """
+    while dl.running:
+        print(f'\r{dl.status()}', end='', flush=True)
+        await asyncio.sleep(interval)
+    print(f'\r{dl.status()}')
+
+
+async def main(urls: list, dest: str) -> int:
+    async with Downloader(dest) as dl:
+        for url in urls:
+            dl.add(url)
+        start = time.monotonic()
+        await asyncio.gather(dl.wait(), show_progress(dl))
+        print(f'{len(dl.done)} done, {len(dl.failed)} failed in '
+              f'{time.monotonic() - start:.1f}s')
+        for url in dl.failed:
+            print(f'failed: {url}')
+    return 1 if dl.failed else 0
+
+
+if __name__ == '__main__':
+    if len(argv) < 3:
+        print(f'Usage: {argv[0]} <dir> <URL>...')
+        exit(1)
+    try:
+        exit(asyncio.run(main(argv[2:], argv[1])))
+    except KeyboardInterrupt:
+        exit(130)
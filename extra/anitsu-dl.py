@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 from optparse import OptionParser
 from urllib.parse import unquote, quote
-from tempfile import mktemp
 import subprocess as sp
 import requests
+import asyncio
 import re
 import os
 import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from downloader import main as download  # noqa: E402
+
 HOME = os.getenv('HOME')
 DL_DIR = os.path.join(HOME, 'Downloads')
 WEBDAV = "cloud.anitsu.moe/nextcloud/public.php/webdav"
@@ -46,21 +49,24 @@ for url in args:
         method='PROPFIND', url=webdav, auth=(user, opts.password),
         headers={'Depth': 'infinity'}
     )
-    files = re.findall(r'public.php/webdav/([^<]*)', r.text)
-    print(f'{len(files)} files found')
+    files = []
+    owned = 0
+    for i in r.text.split('response>'):
+        href = re.search(r'public.php/webdav/([^<]+)', i)
+        size = re.search(r'getcontentlength>(\d+)<', i)
+        if not href or href.group(1).endswith('/'):  # folders
+            continue
+        href = href.group(1)
+        dest = os.path.join(opts.dir, unquote(os.path.basename(href)))
+        if size and os.path.isfile(dest) and \
+                os.path.getsize(dest) == int(size.group(1)):
+            owned += 1
+            continue
+        files.append(href)
+    print(f'{len(files)} files found, {owned} already downloaded')
 
-    tmpfile = mktemp()
+    urls = [f'https://{user}:{opts.password}@{WEBDAV}/{i}' for i in files]
     try:
-        with open(tmpfile, 'w') as fp:
-            for i in files:
-                url = f'https://{user}:{opts.password}@{WEBDAV}/{i}'
-                fp.write(url + '\n')
-
-        p = sp.run([
-            'aria2c', '-j', '2',
-            '--dir', opts.dir, f'--input-file={tmpfile}'
-        ])
-    except KeyboardInterrupt:
+        asyncio.run(download(urls, opts.dir))
+    except KeyboardInterrupt:  # .part files are resumed on the next run
         break
-    finally:
-        os.remove(tmpfile)
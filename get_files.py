@@ -5,22 +5,36 @@ from aiohttp.client_exceptions import ClientConnectorError
 from urllib.parse import unquote
 from html import unescape
 from collections import defaultdict
-from xml.dom import minidom
+from xml.etree import ElementTree
 from shutil import which
 import traceback  # noqa: F401
-import random
 import asyncio
+import socket
 import json
 import re
 
-Q_SIZE = 20
+PROC_JOBS = 8  # rclone/gdrive processes at once
+RC_JOBS = 4  # operations/list calls at once
 RE_GD_FOLDERID = re.compile(r'/folders/([^\?$/]*)')
 RE_GD_FILEID = re.compile(r'(?:[\?&]id=([^&$]*)|/file/d/([^/\?$]*))')
 UNITS = {"B": 1, "K": 10**3, "M": 10**6, "G": 10**9, "T": 10**12}
 HAS_GDRIVE = which('gdrive')
 HAS_RCLONE = which('rclone')
 GD_LINK = 'https://drive.google.com/uc?id={}&export=download&confirm=t'
+DAV = '{DAV:}'
+CHUNK_SIZE = 64 * 1024
+SHARE_JOBS = 6  # Depth: 1 requests at once per share
+INFINITY_TIMEOUT = 120
+PARKS = 3  # times an item waits for its host to come back before failing
+PROBE_WAITS = 60  # times it waits on the request let through to the host
+no_infinity = set()  # hosts that refused a Depth: infinity PROPFIND
+RC_URL = os.getenv('RCLONE_RC_URL')  # use an already running rc server
 counter = 1
+rc_url = None
+gd_cache = dict()  # file id: (name, size)
+gd_failed = set()
+parked = set()  # tasks of the items waiting for their host, see attempt()
+failures = 0
 
 if HAS_RCLONE:
     if os.system('rclone listremotes 2>/dev/null | grep -q ^Anitsu:') != 0:
@@ -28,6 +42,10 @@ if HAS_RCLONE:
         HAS_RCLONE = False
 
 
+class ShareError(Exception):
+    pass
+
+
 def tree():
     return defaultdict(tree)
 
@@ -38,6 +56,51 @@ def set_value(root, path, value, key):
     root[path[-1]] = value
 
 
+class Multistatus:
+    """ Incremental parser of a WebDAV multistatus body, every <d:response>
+    is turned into a dict and dropped as soon as it is closed """
+
+    def __init__(self):
+        self.parser = ElementTree.XMLPullParser(['start', 'end'])
+        self.root = None
+
+    def feed(self, data: bytes) -> list:
+        self.parser.feed(data)
+        return self.read()
+
+    def close(self) -> list:
+        self.parser.close()
+        return self.read()
+
+    def read(self) -> list:
+        out = []
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                if self.root is None:
+                    self.root = elem
+            elif elem.tag == f'{DAV}response':
+                out.append(parse_response(elem))
+                self.root.remove(elem)
+        return out
+
+
+def parse_response(elem) -> dict:
+    def prop(name):
+        # 404 propstats list the missing properties with no text
+        for i in elem.iter(f'{DAV}{name}'):
+            if i.text:
+                return i.text
+        return ''
+
+    size = prop('getcontentlength')
+    return {
+        'href': elem.findtext(f'{DAV}href') or '',
+        'size': int(size) if size else 0,
+        'type': prop('getcontenttype'),
+        'etag': prop('getetag')
+    }
+
+
 def parse_size(size: str) -> int:
     # https://stackoverflow.com/questions/42865724/parse-human-readable-filesizes-into-bytes
     unit = size[-1]
@@ -45,38 +108,150 @@ def parse_size(size: str) -> int:
     return int(float(number) * UNITS[unit])
 
 
-async def random_sleep():
-    await asyncio.sleep(random.random() * .5)
+def post_url(key: str) -> str:
+    return conn.execute('SELECT url FROM posts WHERE id = ?', (key,)).fetchone()[0]
+
+
+async def start_rcd():
+    """ Start one `rclone rcd` for the whole run and return its process """
+    global rc_url
+    if RC_URL:
+        rc_url = RC_URL.rstrip('/')
+        return None
+    if not HAS_RCLONE:
+        return None
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    proc = await asyncio.create_subprocess_exec(
+        'rclone', 'rcd', '--rc-no-auth', f'--rc-addr=127.0.0.1:{port}',
+        '--fast-list', stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(50):
+        await asyncio.sleep(.1)
+        if proc.returncode is not None:
+            break
+        try:
+            async with session.post(f'{url}/core/version') as r:
+                if r.status == 200:
+                    rc_url = url
+                    return proc
+        except ClientConnectorError:
+            pass
+
+    print(f'{RED}rclone rcd did not start, using rclone lsjson{END}')
+    await stop_rcd(proc)
+    return None
+
+
+async def stop_rcd(proc):
+    if proc is None or proc.returncode is not None:
+        return
+    proc.terminate()
+    await proc.wait()
+
+
+async def rc_list(folder_id: str):
+    """ operations/list on the rc server, None if it failed """
+    data = {
+        'fs': f'Anitsu,root_folder_id={folder_id}:',
+        'remote': '',
+        'opt': {'recurse': True, 'filesOnly': True,
+                'noModTime': True, 'noMimeType': True}
+    }
+    async with rc_lock:
+        try:
+            async with session.post(f'{rc_url}/operations/list',
+                                    json=data) as r:
+                if r.status == 200:
+                    return (await r.json())['list']
+                print(f'{RED}rclone rc: {r.status}{END}\n{await r.text()}')
+        except ClientConnectorError as err:
+            print(f'{RED}rclone rc: {err}{END}')
 
 
 async def gd_get_folder(folder_id: str) -> dict:
-    p = await asyncio.create_subprocess_shell(' '.join([
-        'rclone', 'lsjson', '-R', '--fast-list',
-        '--files-only', '--no-modtime', '--no-mimetype',
-        '--drive-root-folder-id', folder_id, 'Anitsu:'
-    ]), stdout=asyncio.subprocess.PIPE)
-    out, _ = await p.communicate()
+    if rc_url:
+        data = await rc_list(folder_id)
+        if data is not None:
+            return data
+
+    async with proc_lock:
+        p = await asyncio.create_subprocess_shell(' '.join([
+            'rclone', 'lsjson', '-R', '--fast-list',
+            '--files-only', '--no-modtime', '--no-mimetype',
+            '--drive-root-folder-id', folder_id, 'Anitsu:'
+        ]), stdout=asyncio.subprocess.PIPE)
+        out, _ = await p.communicate()
     return json.loads(out.decode())
 
 
 async def gd_get_file(file_id: str) -> str:
     if HAS_GDRIVE:
         # if you know how to do this with rclone please tell me T_T
-        p = await asyncio.create_subprocess_shell(' '.join([
-            'gdrive', 'info', '--bytes', file_id
-        ]), stdout=asyncio.subprocess.PIPE)
-        out, _ = await p.communicate()
+        async with proc_lock:
+            p = await asyncio.create_subprocess_shell(' '.join([
+                'gdrive', 'info', '--bytes', file_id
+            ]), stdout=asyncio.subprocess.PIPE)
+            out, _ = await p.communicate()
         return out.decode()
 
     url = GD_LINK.format(file_id)
-    async with session.get(url) as r:
+    async with request(session, 'GET', url) as r:
         return await r.text()
 
 
+def gd_file_id(url: str) -> str:
+    m = RE_GD_FILEID.search(url)
+    return m.group(1 if 'id=' in url else 2) if m else None
+
+
+async def gd_resolve(file_ids) -> dict:
+    """ Resolve name and size of every Drive file not in the cache yet.
+    Ids shared by many posts are only looked up once. Return {file id: error}
+    of the lookups that did not get an answer, those stay unresolved """
+    errors = dict()
+
+    async def resolve(file_id):
+        try:
+            content = await gd_get_file(file_id)
+        except (HostDown, *RETRY_ERRORS) as err:
+            errors[file_id] = err
+            return
+        try:
+            if HAS_GDRIVE:
+                filename = re.search(r'Name: ([^\n]*)', content).group(1)
+                size = int(re.search(r'Size: (\d+)', content).group(1))
+            else:
+                filename, size = re.search(
+                    r'href\=\"\/open.*?>([^<]+)\<\/a\> \((\d+.)\)', content
+                ).group(1, 2)
+                size = parse_size(size)
+        except AttributeError as err:
+            print(f'{RED}{err}{END}\n{content = }\n{GD_LINK.format(file_id)}')
+            gd_failed.add(file_id)
+            return
+
+        filename = unescape(filename)
+        gd_cache[file_id] = (filename, size)
+        save_gd_file(conn, file_id, filename, size)
+
+    missing = [i for i in dict.fromkeys(file_ids)
+               if i and i not in gd_cache and i not in gd_failed]
+    if missing:
+        print(f'resolving {len(missing)} google drive files...')
+        await asyncio.gather(*[resolve(i) for i in missing])
+    return errors
+
+
 async def google_drive(key: str, url: str):
     root = tree()
     if '/folders/' in url:
-        if not HAS_RCLONE:
+        if not HAS_RCLONE and not rc_url:
             print(f'Skipping {url}...')
             return
 
@@ -89,27 +264,90 @@ async def google_drive(key: str, url: str):
             path[-1] = f'{key}:{size}:{path[-1]}'
             set_value(root, path, dl_link, key)
     else:
-        file_id = RE_GD_FILEID.search(url).group(1 if 'id=' in url else 2)
-        content = await gd_get_file(file_id)
-        try:
-            if HAS_GDRIVE:
-                filename = re.search(r'Name: ([^\n]*)', content).group(1)
-                size = re.search(r'Size: (\d+)', content).group(1)
-            else:
-                filename, size = re.search(
-                    r'href\=\"\/open.*?>([^<]+)\<\/a\> \((\d+.)\)', content
-                ).group(1, 2)
-                size = parse_size(size)
-        except AttributeError as err:
-            print(f'{RED}{err}{END}\n{content = }\n{url}\n{db[key]["url"]}')
-            return
-
+        file_id = gd_file_id(url)
+        err = (await gd_resolve([file_id])).get(file_id)
+        if isinstance(err, HostDown):
+            raise err
+        if err is not None:
+            raise ShareError(f'lookup failed: {err!r}')
+        if file_id not in gd_cache:
+            raise ShareError('not found')
+
+        filename, size = gd_cache[file_id]
         dl_link = GD_LINK.format(file_id)
-        filename = f'{key}:{size}:{unescape(filename)}'
-        root[filename] = dl_link
+        root[f'{key}:{size}:{filename}'] = dl_link
 
     # print(json.dumps(root, indent=2))
-    db[key]['gdrive'][url] = root
+    save_tree(conn, key, url, root)
+
+
+async def propfind(url: str, auth, depth: str, callback) -> int:
+    """ Stream a PROPFIND multistatus into `callback` and return the status """
+    async with request(session, 'PROPFIND', url, auth=auth,
+                       headers={'Depth': depth}) as r:
+        if r.status not in [200, 207]:
+            return r.status
+        parser = Multistatus()
+        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+            callback(parser.feed(chunk))
+        callback(parser.close())
+        return r.status
+
+
+def get_node(root: dict, path: str, key: str):
+    """ Return the directory at `path` (quoted, '/' separated) or None """
+    for d in path.split('/'):
+        root = root.get(f'{key}:0:{unquote(d).strip()}')
+        if root is None:
+            return None
+    return root
+
+
+async def nextcloud_walk(webdav: str, auth, add, reuse) -> int:
+    """ Walk the share breadth-first with up to SHARE_JOBS concurrent
+    Depth: 1 requests, descending only into folders for which `reuse`
+    returns False """
+    queue = asyncio.Queue()
+    queue.put_nowait('')
+    status, error = 207, None
+
+    async def worker():
+        nonlocal status, error
+        while True:
+            path = await queue.get()
+            try:
+                if status in [200, 207] and error is None:
+                    children = []
+                    r = await propfind(f'https://{webdav}/{path}', auth, '1',
+                                       children.extend)
+                    if r not in [200, 207]:
+                        status = r
+                    for e in children:
+                        p = e['href'].split('webdav')[-1][1:]
+                        if p.rstrip('/') == path:
+                            if not path:  # the root, can be a single file
+                                add([e])
+                            continue
+                        add([e])
+                        p = p.rstrip('/')
+                        if e['href'].endswith('/') and not reuse(p, e['etag']):
+                            queue.put_nowait(p)
+            except Exception as err:
+                error = err
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(SHARE_JOBS)]
+    try:
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if error is not None:
+        raise error
+    return status
 
 
 async def nextcloud(key: str, url: str, password=''):
@@ -117,119 +355,297 @@ async def nextcloud(key: str, url: str, password=''):
     domain = url.split("/")[0]
     webdav = f'{domain}/nextcloud/public.php/webdav'
     auth = BasicAuth(user, password)
-    try:
-        async with session.request(method='PROPFIND', auth=auth,
-                                   url=f'https://{webdav}',
-                                   headers={'Depth': 'infinity'}) as r:
-            if r.status not in [200, 207]:
-                print(f'{RED}{r.status = }{END}\n{url}\n{db[key]["url"]}')
-                return
-            xml = await r.text()
-    except ClientConnectorError as err:
-        print(f'{RED}Error: {err}{END}\n{url}\n{db[key]["url"]}')
-        return
-
-    dom = minidom.parseString(xml)
     root = tree()
-    for e in dom.getElementsByTagName('d:response'):
-        href = e.getElementsByTagName('d:href')
-        if not href:
-            continue
-        path = href[0].firstChild.data.split('webdav')[-1][1:]
-        if not path or path.endswith('/'):
-            continue  # hopefully the first item of this loop... :-)
-
-        prop = e.getElementsByTagName('d:prop')[0]
-        size = prop.getElementsByTagName('d:getcontentlength')
-        size = int(size[0].firstChild.data)
-
-        dl_link = f'https://{user}:{password}@{webdav}/{path}'
-        path = path.split('/')
-        path[-1] = f'{key}:{size}:{unquote(path[-1])}'
-        set_value(root, path, dl_link, key)
-
-    if not root and 'contenttype>video/' in xml:
-        async with session.request(method='HEAD', auth=auth,
-                                   url=f'https://{webdav}') as r:
+    etags = dict()
+    has_video = False
+
+    old_etags = get_etags(conn, key, url)
+    old_root = get_tree(conn, key, url) if old_etags else None
+
+    def add(entries):
+        nonlocal has_video
+        for e in entries:
+            has_video = has_video or e['type'].startswith('video/')
+            path = e['href'].split('webdav')[-1][1:]
+            if not path or path.endswith('/'):
+                etags[path.rstrip('/')] = e['etag']
+                continue
+
+            dl_link = f'https://{user}:{password}@{webdav}/{path}'
+            path = path.split('/')
+            path[-1] = f'{key}:{e["size"]}:{unquote(path[-1])}'
+            set_value(root, path, dl_link, key)
+
+    def reuse(path, etag) -> bool:
+        """ Splice the old subtree of an unchanged folder into the new tree """
+        if old_etags.get(path) != etag:
+            return False
+        node = get_node(old_root, path, key)
+        if node:  # folders without files are not in the tree
+            # the parents may have no files of their own, so no node yet
+            *parent, name = path.split('/')
+            set_value(root, parent + [f'{key}:0:{unquote(name).strip()}'],
+                      node, key)
+        for k, v in old_etags.items():
+            if k.startswith(f'{path}/'):
+                etags[k] = v
+        return True
+
+    status = 207
+    if old_root:
+        # Nextcloud propagates etags up, an unchanged root means
+        # nothing changed below it
+        probe = []
+        status = await propfind(f'https://{webdav}', auth, '0',
+                                probe.extend)
+        if probe and probe[0]['etag'] == old_etags.get(''):
+            return
+        if probe:
+            status = await nextcloud_walk(webdav, auth, add, reuse)
+            etags[''] = probe[0]['etag']
+
+    if status in [200, 207] and not root:
+        etags.clear()
+        status = 0
+        if domain not in no_infinity:
+            try:
+                status = await asyncio.wait_for(propfind(
+                    f'https://{webdav}', auth, 'infinity', add
+                ), INFINITY_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+
+        if status in [0, 400, 403, 501, 507]:
+            # infinity is disabled, capped or just too slow for this share
+            if status:
+                no_infinity.add(domain)
+            root.clear()
+            etags.clear()
+            status = await nextcloud_walk(webdav, auth, add,
+                                          lambda *_: False)
+
+    if status not in [200, 207]:
+        raise ShareError(f'{status = }')
+
+    if not root and has_video:
+        async with request(session, 'HEAD', f'https://{webdav}',
+                           auth=auth) as r:
             content = r.headers['content-disposition']
             size = r.headers['content-length']
-        # size = re.search(r'd:getcontentlength>(\d+)<', xml).group(1)
         dl_link = f'https://{user}:{password}@{webdav}/'
         filename = re.search(r'filename=\"([^\"]*)', content).group(1)
         filename = f'{key}:{size}:{unquote(filename)}'
         root[filename] = dl_link
 
     # print(json.dumps(root, indent=2))
-    db[key]['nextcloud'][url] = root
+    save_tree(conn, key, url, root, etags)
+
+
+async def handle(k: str, url: str):
+    if '/nextcloud/' in url:
+        pw = get_post(conn, k, trees=False)['password'] or ''
+        await nextcloud(k, url, pw)
+    elif 'drive.google' in url:
+        await google_drive(k, url)
+
+
+async def attempt(k: str, url: str, parks=0, probes=0):
+    """ List a share and record how it went in the pending table. While
+    the circuit of its host is open the item is parked, so the workers move
+    on to other hosts, and tried again once it lets requests through. It
+    fails like any other error after PARKS times, waits on the request let
+    through to probe the host count apart up to PROBE_WAITS """
+    global failures
+    try:
+        await handle(k, url)
+        done_pending(conn, k, url)
+        return
+    except HostDown as err:
+        parks += not err.probing
+        probes += err.probing
+        if parks <= PARKS and probes <= PROBE_WAITS:
+            task = asyncio.create_task(
+                unpark(k, url, err.wait, parks, probes))
+            parked.add(task)
+            task.add_done_callback(parked.discard)
+            return
+        error = err
+    except Exception as err:
+        error = err
+    print(f'{RED}Error: {error}{END}\n{url}\n{post_url(k)}')
+    fail_pending(conn, k, url, str(error) or repr(error))
+    failures += 1
+
+
+async def unpark(k: str, url: str, wait: float, parks: int, probes: int):
+    await asyncio.sleep(wait)
+    await attempt(k, url, parks, probes)
+
+
+async def wait_parked():
+    while parked:
+        await asyncio.gather(*parked, return_exceptions=True)
+
+
+def report():
+    if failures:
+        print(f'{RED}{failures} items failed, they are tried again in the '
+              f'next run{END}')
 
 
 async def q_handler(queue: asyncio.Queue):
     global counter
     while True:
         k, url = await queue.get()
-
-        if '/nextcloud/' in url:
-            pw = '' if 'password' not in db[k] else db[k]['password']
-            await nextcloud(k, url, pw)
-        elif 'drive.google' in url:
-            await google_drive(k, url)
-
+        await attempt(k, url)
         counter += 1
         pbar(counter, qsize)
-        await random_sleep()
         queue.task_done()
 
 
-def gen_only_files(db: dict):
-    files = dict()
-    for k, v in db.items():
-        title = db[k]['title']
-        s = f'{k}:0:{title}'
-        files[s] = dict()
-        for v2 in v['nextcloud'].values():
-            files[s].update(v2)
-        for v2 in v['gdrive'].values():
-            files[s].update(v2)
+def checkpoint(resume: bool) -> list:
+    """ Record the shares to list in the pending table and return the
+    (post_id, url) items not done yet. Every item is marked done as soon as
+    it is saved, so a run that is interrupted is resumed with exactly the
+    items it had left plus the shares never listed that were added since """
+    if resume:
+        print(f'{YEL}resuming an interrupted run{END}')
+    add_pending(conn, pending_shares(conn, releasing=not resume))
+    add_pending(conn, load_failed(conn))
+    return load_pending(conn)
+
+
+async def stream(posts: asyncio.Queue):
+    """ Pipeline stage, list the shares of every post id taken from `posts`
+    until a None, then the ones left from earlier runs or still releasing.
+    rclone rcd is only started once a folder link shows up """
+    global session, conn, proc_lock, rc_lock, gd_cache
+    conn = open_db()
+    gd_cache = load_gd_files(conn)
+    proc_lock = asyncio.Semaphore(PROC_JOBS)
+    rc_lock = asyncio.Semaphore(RC_JOBS)
+    rcd_lock = asyncio.Lock()
+    rcd = None
+    started = False
+    keys = set()
+    left = dict()  # post id: urls of the items left by checkpoint()
+    resume = has_pending(conn)
+
+    async def worker(queue):
+        nonlocal rcd, started
+        while True:
+            k = await queue.get()
+            if k is None:
+                queue.put_nowait(None)  # for the other workers
+                return
+            keys.add(k)
+            if k in left:
+                items = [(k, url) for url in left.pop(k)]
+            else:
+                items = pending_shares(conn, k)
+                add_pending(conn, items)
+            await gd_resolve([gd_file_id(url) for _, url in items if
+                              'drive.google' in url and '/folders/' not in url])
+            for _, url in items:
+                if '/folders/' in url:
+                    async with rcd_lock:
+                        if not started:
+                            started = True
+                            rcd = await start_rcd()
+                await attempt(k, url)
+
+    async def run(queue):
+        await asyncio.gather(*[worker(queue) for _ in range(MAX_INFLIGHT)])
 
-    def count(d: dict) -> int:
-        return sum(1 if not isinstance(d[k], dict) else count(d[k]) for k in d)
+    async with ClientSession() as session:
+        try:
+            await run(posts)
+            for k, url in checkpoint(resume):
+                if k not in keys:
+                    left.setdefault(k, []).append(url)
+            rest = asyncio.Queue()
+            for k in list(left):
+                rest.put_nowait(k)
+            rest.put_nowait(None)
+            await run(rest)
+            await wait_parked()
+        finally:
+            for task in list(parked):
+                task.cancel()
+            await stop_rcd(rcd)
+
+    gen_only_files(conn, keys | pending_posts(conn))
+    clear_pending(conn)
+    report()
+
+
+def gen_only_files(conn, keys=()):
+    """ Merge the share trees of `keys` and of every post missing from the
+    files table (or stored in an older format) into one Tree per post """
+    keys = set(keys) | {i for i, in conn.execute(
+        'SELECT id FROM posts WHERE id NOT IN '
+        '(SELECT post_id FROM files WHERE version = ?)', (FILES_VERSION,))}
+
+    total = 0
+    for k in sorted(keys):
+        post = get_post(conn, k)
+        if post is None:
+            continue
+        files = dict()
+        for v in post['nextcloud'].values():
+            files.update(v)
+        for v in post['gdrive'].values():
+            files.update(v)
+        tree = Tree.from_dict(k, post['title'], files)
+        total += tree.count[0]
+        save_files(conn, k, post['title'], tree)
 
-    print(count(files), 'files')
-    with open(FILES_DB, 'w') as fp:
-        json.dump(files, fp)
+    print(total, 'files updated')
 
 
 async def main():
-    global session, db, qsize
-    with open(DB, 'r') as fp:
-        db = json.load(fp)
-
+    global session, conn, qsize, proc_lock, rc_lock, gd_cache
+    conn = open_db()
+    gd_cache = load_gd_files(conn)
+    proc_lock = asyncio.Semaphore(PROC_JOBS)
+    rc_lock = asyncio.Semaphore(RC_JOBS)
 
     queue = asyncio.Queue()
     async with ClientSession() as session:
-        for k, v in db.items():
-            for url in v['nextcloud']:
-                if not v['nextcloud'][url] or v['is_release']:
-                    queue.put_nowait((k, url))
-            for url in v['gdrive']:
-                if not v['gdrive'][url] or v['is_release']:
-                    queue.put_nowait((k, url))
-
-        qsize = queue.qsize()
-        print(f'{qsize} items to update, please wait...')
-        pbar(counter, qsize)
-        tasks = []
-        for _ in range(Q_SIZE):
-            tasks += [asyncio.create_task(q_handler(queue))]
-        await queue.join()
-        for task in tasks:
-            task.cancel()
-        await asyncio.gather(*tasks, return_exceptions=True)
+        items = checkpoint(has_pending(conn))
+        for k, url in items:
+            queue.put_nowait((k, url))
 
-    with open(DB, 'w') as fp:
-        json.dump(db, fp)
+        rcd = None
+        if any('/folders/' in url for _, url in items):
+            rcd = await start_rcd()
 
-    gen_only_files(db)
+        try:
+            # a lookup that fails is made again by the item of its share
+            await gd_resolve([
+                gd_file_id(url) for _, url in items
+                if 'drive.google' in url and '/folders/' not in url
+            ])
+
+            qsize = queue.qsize()
+            print(f'{qsize} items to update, please wait...')
+            pbar(counter, qsize)
+            tasks = []
+            for _ in range(MAX_INFLIGHT):
+                tasks += [asyncio.create_task(q_handler(queue))]
+            try:
+                await queue.join()
+                await wait_parked()
+            finally:
+                for task in tasks + list(parked):
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            await stop_rcd(rcd)
+
+    gen_only_files(conn, pending_posts(conn))
+    clear_pending(conn)
+    report()
 
 
 if __name__ == '__main__':
@@ -4,9 +4,9 @@ from datetime import datetime
 from aiohttp import ClientSession, BasicAuth
 from html import unescape
 from getpass import getpass
+from concurrent.futures import ProcessPoolExecutor
 import asyncio
 import json
-import random
 import re
 
 CONFIG = os.path.join(ROOT, '.config')
@@ -19,7 +19,9 @@ RE_ANI = re.compile(r'anilist\.co/\w*/(\d*)')
 RE_NXC = re.compile(r'//([^/]*/nextcloud/\w/[^\?\"]+)')
 RE_GDR = re.compile(r'href=\"(https://drive\.google[^\"]*)')
 RE_PASS = re.compile(r'Senha: <span[^>]*>(.*)</span')
-Q_SIZE = 10
+FIRST_RUN = '2000-01-01T00:00:00'
+pool = None
+failed = []  # pages that could not be read or saved
 
 
 def get_auth():
@@ -48,137 +50,212 @@ def regex(expr, text):
         return ''
 
 
-async def random_sleep():
-    await asyncio.sleep(random.random() * .5)
-
-
-async def update_db(posts):
-    global db
-    for post in posts:
-        post_id = str(post['id'])
-        modified = post['modified']
-        content = post['content']['rendered']
-        title = clean_text(post['title']['rendered'])
-
-
-        if post_id not in db:
+def is_release(content: str) -> bool:
+    """ Same as `'em lançamento' in content.lower()` without lowering the
+    whole post, only the text around each candidate is lowered """
+    for word in ['ançamento', 'ANÇAMENTO']:
+        i = content.find(word)
+        while i != -1:
+            if content[max(i - 4, 0):i + 9].lower() == 'em lançamento':
+                return True
+            i = content.find(word, i + 1)
+    return False
+
+
+def parse_content(content: str) -> dict:
+    """ Extract everything update_db needs from a post body """
+    nextcloud = RE_NXC.findall(content)
+    gdrive = RE_GDR.findall(content)
+    return {
+        'password': regex(RE_PASS, content),
+        'image_url': regex(RE_IMG, content),
+        'malid': regex(RE_MAL, content),
+        'anilist': regex(RE_ANI, content),
+        'nextcloud': nextcloud,
+        'gdrive': gdrive,
+        'is_release': is_release(content),
+        'paywall': not (nextcloud or gdrive) and '_paywall' in content
+    }
+
+
+def parse_page(body: bytes) -> list:
+    """ Decode a page of posts into plain dicts, runs in the process pool """
+    out = []
+    for post in json.loads(body):
+        data = parse_content(post['content']['rendered'])
+        data['id'] = str(post['id'])
+        data['title'] = clean_text(post['title']['rendered'])
+        data['url'] = post['link']
+        data['date'] = post['date']
+        data['modified'] = post['modified']
+        out.append(data)
+    return out
+
+
+async def parse(body: bytes) -> list:
+    if pool is None:
+        return parse_page(body)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, parse_page, body)
+
+
+async def update_db(posts, outs=()):
+    """ Save a page of posts, the id of every post saved is also put in
+    each queue of `outs` """
+    for content in posts:
+        post_id = content['id']
+        modified = content['modified']
+        title = content['title']
+
+        data = get_post(conn, post_id, trees=False)
+        if data is None:
             print(f'[{GRN}{modified}{END}] {title}')
-            db[post_id] = dict()
-            db[post_id]['nextcloud'] = dict()
-            db[post_id]['gdrive'] = dict()
+            data = dict()
+            data['nextcloud'] = dict()
+            data['gdrive'] = dict()
 
-        if 'modified' in db[post_id]:
-            mod = db[post_id]['modified']
+        if 'modified' in data:
+            mod = data['modified']
             if modified != mod:
                 print(f'[{RED}{mod}{END} > {GRN}{modified}{END}] {title}')
-                db[post_id]['nextcloud'] = dict()
-                db[post_id]['gdrive'] = dict()
+                data['nextcloud'] = dict()
+                data['gdrive'] = dict()
 
-        pw = RE_PASS.search(content)
-        pw = '' if not pw else pw.group(1)
+        pw = content['password']
         if pw:
             print(f'{RED}Password: {pw}{END}')
 
-        db[post_id]['password'] = pw
-        db[post_id]['title'] = title
-        db[post_id]['url'] = post['link']
-        db[post_id]['date'] = post['date']
-        db[post_id]['modified'] = modified
-        db[post_id]['is_release'] = 'em lançamento' in content.lower()
-        db[post_id]['image'] = os.path.join(IMG_DIR, f'{post_id}.jpg')
-        db[post_id]['image_url'] = regex(RE_IMG, content)
-        db[post_id]['malid'] = regex(RE_MAL, content)
-        db[post_id]['anilist'] = regex(RE_ANI, content)
-
-        nextcloud_links = RE_NXC.findall(content)
+        data['password'] = pw
+        data['title'] = title
+        data['url'] = content['url']
+        data['date'] = content['date']
+        data['modified'] = modified
+        data['is_release'] = content['is_release']
+        data['image'] = os.path.join(IMG_DIR, f'{post_id}.jpg')
+        data['image_url'] = content['image_url']
+        data['malid'] = content['malid']
+        data['anilist'] = content['anilist']
+
+        nextcloud_links = content['nextcloud']
         has_files = bool(nextcloud_links)
         for i in nextcloud_links:
-            if i not in db[post_id]['nextcloud']:
-                db[post_id]['nextcloud'][i] = dict()
+            if i not in data['nextcloud']:
+                data['nextcloud'][i] = dict()
 
-        gdrive_links = RE_GDR.findall(content)
+        gdrive_links = content['gdrive']
         has_files = bool(gdrive_links) if not has_files else has_files
         for i in gdrive_links:
-            if i not in db[post_id]['gdrive']:
-                db[post_id]['gdrive'][i] = dict()
+            if i not in data['gdrive']:
+                data['gdrive'][i] = dict()
 
-        if '_paywall' in content and not has_files:
+        if content['paywall']:
+            save_post(conn, post_id, data)
             print('Eu adoro como a anitsu foi de uma ideia até que legal para merda bem rápido. Staff ficou cega com dinheiro e agora só quer ganhar dinheiro com o que é de graça. É triste como o interesse fode projetos legais.')
-            return
+            continue
 
         if not has_files:
             # https://anitsu.moe/wp-json/wp/v2/posts?include={post_id}
             print(f'nothing found, post {post_id} deleted')
-            del db[post_id]
+            delete_post(conn, post_id)
+            continue
+
+        save_post(conn, post_id, data)
+        for queue in outs:
+            await queue.put(post_id)
 
 
-async def get_posts(queue):
+async def get_posts(queue, outs=()):
     while True:
         url = await queue.get()
-        async with session.get(url) as r:
-            posts = await r.json()
-        out = await update_db(posts)
-        if out:
-            break
-        await random_sleep()
-        queue.task_done()
-
-
-async def main():
-    global session, db
-    try:
-        with open(DB, 'r') as fp:
-            db = json.load(fp)
-    except FileNotFoundError:
-        db = dict()
-
-    if os.path.exists(LAST_RUN) and db:
+        try:
+            async with request(session, 'GET', url) as r:
+                r.raise_for_status()
+                body = await r.read()
+            await update_db(await parse(body), outs)
+        except Exception as err:
+            print(f'{RED}Error: {err}{END}\n{url}')
+            failed.append(url)
+        finally:
+            queue.task_done()
+
+
+def save_last_run(now: str):
+    """ Write LAST_RUN through a temporary file, it is either the old or
+    the new date even if the run is killed halfway """
+    tmp = f'{LAST_RUN}.tmp'
+    with open(tmp, 'w') as fp:
+        fp.write(now)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, LAST_RUN)
+
+
+async def main(outs=()):
+    """ Sync the posts modified since the last run, see update_db() for
+    `outs` """
+    global session, conn, pool
+    conn = open_db()
+
+    if os.path.exists(LAST_RUN) and count_posts(conn):
         with open(LAST_RUN, 'r') as fp:
             last_run = fp.read()
     else:
-        last_run = '2000-01-01T00:00:00'
+        last_run = FIRST_RUN
 
+    # taken before the first request, posts modified while this run reads
+    # the pages are read again by the next one. LAST_RUN is only written
+    # once every page was saved
     now = datetime.isoformat(datetime.now())
-    open(LAST_RUN, 'w').write(now)
 
     user, passwd = get_auth()
     auth = BasicAuth(user, passwd)
     async with ClientSession(auth=auth) as session:
         print('requesting first page, please wait...')
         url = WP_URL.format(1, last_run)
-        async with session.get(url, timeout=30) as r:
+        async with request(session, 'GET', url, timeout=30) as r:
             if r.status != 200:
                 print(f'{r.status}, check your user and password')
                 __import__('sys').exit(1)
 
             total_pages = int(r.headers['x-wp-totalpages'])
             total_posts = int(r.headers['x-wp-total'])
-            posts = await r.json()
+            body = await r.read()
 
+        posts = await parse(body)
         if not posts:
+            save_last_run(now)
             return
 
         print(f'total pages: {total_pages}\ntotal posts: {total_posts}')
-        await update_db(posts)
+        await update_db(posts, outs)
         queue = asyncio.Queue()
         for p in range(2, total_pages + 1):
             queue.put_nowait(WP_URL.format(p, last_run))
 
+        # only a full sync has enough pages to be worth the worker processes
+        if last_run == FIRST_RUN and total_pages > 1:
+            pool = ProcessPoolExecutor()
+
         tasks = []
-        for _ in range(Q_SIZE):
-            tasks += [asyncio.create_task(get_posts(queue))]
+        for _ in range(min(MAX_INFLIGHT, total_pages - 1)):
+            tasks += [asyncio.create_task(get_posts(queue, outs))]
         await queue.join()
 
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
 
-    with open(DB, 'w') as fp:
-        json.dump(db, fp)
+    if pool is not None:
+        pool.shutdown()
+
+    if failed:
+        print(f'{RED}{len(failed)} pages failed, {LAST_RUN} not updated{END}')
+        return 1
+    save_last_run(now)
 
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        sys.exit(asyncio.run(main()))
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+""" get_posts.py, get_files.py and download_images.py in one process. The
+id of every post saved goes through a bounded queue to each later stage, so
+its shares and its image are fetched while the next pages are still being
+read and a slow stage holds back the posts instead of piling them up """
+from sys import argv, exit
+import asyncio
+import get_posts
+import get_files
+import download_images
+
+QUEUE_SIZE = 256  # post ids waiting for a stage
+
+
+async def posts(queues: list) -> int:
+    code = await get_posts.main(queues)
+    for queue in queues:
+        await queue.put(None)
+    return code or 0
+
+
+async def main(images=False) -> int:
+    """ Return the exit code of get_posts, a stage that fails cancels the
+    others and its error is raised """
+    queues = [asyncio.Queue(QUEUE_SIZE)]
+    stages = [asyncio.create_task(get_files.stream(queues[0]))]
+    if images:
+        queues.append(asyncio.Queue(QUEUE_SIZE))
+        stages.append(asyncio.create_task(download_images.stream(queues[1])))
+    # waited on together, a stage that is gone would leave get_posts
+    # blocked on its full queue
+    producer = asyncio.create_task(posts(queues))
+    tasks = [producer] + stages
+
+    try:
+        done, _ = await asyncio.wait(tasks,
+                                     return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+        return producer.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    try:
+        exit(asyncio.run(main('-i' in argv or '--download-images' in argv)))
+    except KeyboardInterrupt:
+        pass
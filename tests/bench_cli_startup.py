@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+""" Time and memory the CLI spends before fzf gets its input: the titles read
+from the files_titles index, against loading the tree of every post as it
+did before. python tests/bench_cli_startup.py [posts] """
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils import Tree, open_db, save_post, save_files, load_titles, \
+    load_files, load_tree  # noqa: E402
+
+
+def catalog(posts: int) -> dict:
+    """ {post id: (title, tree)} of seasons with 5 to 40 episodes each """
+    random.seed(1)
+    out = dict()
+    for p in range(posts):
+        k = str(10000 + p)
+        tree = dict()
+        for d in range(random.randint(1, 6)):
+            tree[f'{k}:0:Season {d}'] = {
+                f'{k}:{random.randint(10 ** 8, 2 * 10 ** 9)}:[Group] Some '
+                f'Anime Title S{d} - {e:02d} [1080p][HEVC].mkv':
+                f'https://cloud.anitsu.moe/nextcloud/s/AbCdEfGh{k}/download'
+                f'?path=/S{d}&files={e:02d}.mkv'
+                for e in range(random.randint(5, 40))}
+        out[k] = (f'Title of post {k}', tree)
+    return out
+
+
+def measure(path: str, load):
+    """ Seconds and peak bytes of `load` on a new connection, timed in a
+    first pass since tracemalloc slows it down """
+    conn = open_db(path)
+    start = time.perf_counter()
+    load(conn)
+    elapsed = time.perf_counter() - start
+    conn.close()
+
+    conn = open_db(path)
+    tracemalloc.start()
+    load(conn)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    conn.close()
+    return elapsed, peak
+
+
+def main(posts: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'anitsu.sqlite')
+        conn = open_db(path)
+        files = 0
+        for k, (title, tree) in catalog(posts).items():
+            tree = Tree.from_dict(k, title, tree)
+            files += tree.count[0]
+            save_post(conn, k, {'title': title})
+            save_files(conn, k, title, tree)
+        conn.close()
+        print(f'{posts} posts, {files} files, '
+              f'{os.path.getsize(path) / 1e6:.1f}MB')
+
+        for name, load in [
+            ('title index', lambda c: [f'{k}:0:{t}' for k, t in
+                                       load_titles(c)]),
+            ('all trees', lambda c: [f'{k}:0:{t.name[0]}' for k, t in
+                                     load_files(c).items()]),
+            ('one tree', lambda c: load_tree(c, str(10000 + posts // 2)))
+        ]:
+            elapsed, peak = measure(path, load)
+            print(f'{name:>11}: {elapsed * 1000:.1f}ms, '
+                  f'peak {peak / 1e6:.1f}MB')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4000)
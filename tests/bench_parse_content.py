@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+""" Time get_posts.parse_content() against the regexes update_db used to run
+inline, on synthetic post bodies. python tests/bench_parse_content.py """
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from get_posts import *  # noqa: E402
+
+POSTS = 200
+FILLER = '<p style="text-align: center;"><strong>Lorem ipsum dolor sit ' \
+    'amet</strong>, consectetur adipiscing elit, sed do eiusmod tempor ' \
+    '<em>incididunt</em> ut labore et dolore magna aliqua.</p>\n'
+
+
+def body() -> str:
+    parts = [
+        '<p><img class="aligncenter" src="https://anitsu.moe/wp-content/'
+        'uploads/2021/01/cover.jpg" width="400"/></p>\n',
+        '<p><a href="https://myanimelist.net/anime/12345/Foo">MAL</a> '
+        '<a href="https://anilist.co/anime/12345/">AniList</a></p>\n',
+        '<p>Status: Em Lançamento</p>\n',
+        '<p>Senha: <span style="color:red">abc123</span></p>\n'
+    ]
+    for i in range(30):
+        parts.append('<p><a href="https://cloud.anitsu.moe/nextcloud/s/'
+                     f'AbCd{i}EfGh">Episódio {i}</a></p>\n')
+    for i in range(10):
+        parts.append('<p><a href="https://drive.google.com/file/d/'
+                     f'1XyZ{i}abc/view?usp=sharing">Drive {i}</a></p>\n')
+    parts += [FILLER] * 150
+    random.shuffle(parts)
+    return ''.join(parts)
+
+
+def inline(content: str) -> dict:
+    """ What update_db did before parse_content() """
+    nextcloud = RE_NXC.findall(content)
+    gdrive = RE_GDR.findall(content)
+    return {
+        'password': regex(RE_PASS, content),
+        'image_url': regex(RE_IMG, content),
+        'malid': regex(RE_MAL, content),
+        'anilist': regex(RE_ANI, content),
+        'nextcloud': nextcloud,
+        'gdrive': gdrive,
+        'is_release': 'em lançamento' in content.lower(),
+        'paywall': '_paywall' in content and not (nextcloud or gdrive)
+    }
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    corpus = [body() for _ in range(POSTS)]
+    assert all(inline(i) == parse_content(i) for i in corpus)
+    print(f'{POSTS} posts of ~{len(corpus[0]) // 1000}KB, best of 5')
+    for f in [inline, parse_content]:
+        t = min(timeit.repeat(lambda: [f(i) for i in corpus],
+                              number=3, repeat=5))
+        print(f'{f.__name__:>13}: {t:.3f}s')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+""" Time and peak memory of listing a large Depth: infinity multistatus,
+read whole into minidom as nextcloud() used to and streamed through
+get_files.Multistatus. python tests/bench_propfind.py [entries] """
+import os
+import sys
+import time
+import asyncio
+import tracemalloc
+from aiohttp import web, ClientSession
+from urllib.parse import unquote
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import get_files  # noqa: E402
+from stand_ins import serve  # noqa: E402
+
+DAV = '/nextcloud/public.php/webdav/'
+
+
+def multistatus(n: int) -> bytes:
+    out = ['<?xml version="1.0"?>\n<d:multistatus xmlns:d="DAV:">'
+           f'<d:response><d:href>{DAV}</d:href><d:propstat><d:prop>'
+           '<d:getetag>"root"</d:getetag><d:resourcetype><d:collection/>'
+           '</d:resourcetype></d:prop></d:propstat></d:response>']
+    for i in range(n):
+        folder = f'Season%20{i // 1000}/'
+        if i % 1000 == 0:
+            out.append(
+                f'<d:response><d:href>{DAV}{folder}</d:href><d:propstat>'
+                f'<d:prop><d:getetag>"d{i}"</d:getetag><d:resourcetype>'
+                '<d:collection/></d:resourcetype></d:prop></d:propstat>'
+                '<d:propstat><d:prop><d:getcontentlength/>'
+                '<d:getcontenttype/></d:prop><d:status>HTTP/1.1 404 Not '
+                'Found</d:status></d:propstat></d:response>')
+        out.append(
+            f'<d:response><d:href>{DAV}{folder}%5BGroup%5D%20Show%20-%20'
+            f'{i:05d}%20%281080p%29.mkv</d:href><d:propstat><d:prop>'
+            f'<d:getcontentlength>{10 ** 9 + i}</d:getcontentlength>'
+            f'<d:resourcetype/><d:getetag>"f{i}"</d:getetag>'
+            '<d:getcontenttype>video/x-matroska</d:getcontenttype></d:prop>'
+            '<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+    out.append('</d:multistatus>')
+    return ''.join(out).encode()
+
+
+def add(root: dict, path: str, size: int):
+    if not path or path.endswith('/'):
+        return
+    path = path.split('/')
+    path[-1] = f'1:{size}:{unquote(path[-1])}'
+    get_files.set_value(root, path, '', '1')
+
+
+async def read_dom(r) -> dict:
+    """ The body as a string and a DOM, as nextcloud() did before """
+    root = get_files.tree()
+    dom = minidom.parseString(await r.text())
+    for e in dom.getElementsByTagName('d:response'):
+        path = e.getElementsByTagName('d:href')[0].firstChild.data
+        size = e.getElementsByTagName('d:getcontentlength')
+        size = size[0].firstChild if size else None
+        add(root, path.split('webdav')[-1][1:], size and int(size.data))
+    return root
+
+
+async def read_stream(r) -> dict:
+    root = get_files.tree()
+    parser = get_files.Multistatus()
+
+    def callback(entries):
+        for e in entries:
+            add(root, e['href'].split('webdav')[-1][1:], e['size'])
+    async for chunk in r.content.iter_chunked(get_files.CHUNK_SIZE):
+        callback(parser.feed(chunk))
+    callback(parser.close())
+    return root
+
+
+async def main(n: int):
+    body = multistatus(n)
+    print(f'{n} entries, {len(body) / 1e6:.1f}MB')
+
+    async def handler(request):
+        r = web.StreamResponse(status=207)
+        await r.prepare(request)
+        for i in range(0, len(body), get_files.CHUNK_SIZE):
+            await r.write(body[i:i + get_files.CHUNK_SIZE])
+        return r
+
+    async with serve([web.route('PROPFIND', '/', handler)]) as host, \
+            ClientSession() as session:
+        trees = []
+        for read in [read_dom, read_stream]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            async with session.request('PROPFIND', f'http://{host}/') as r:
+                root = await read(r)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{read.__name__:>11}: {elapsed:.2f}s, '
+                  f'peak {peak / 1e6:.0f}MB')
+            trees.append(root)
+        assert trees[0] == trees[1]
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+""" Stored size, load time and memory of every post tree in the nested json
+layout against utils.Tree. python tests/bench_tree_format.py [posts] """
+import gc
+import os
+import sys
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils import Tree  # noqa: E402
+from bench_cli_startup import catalog  # noqa: E402
+
+
+def load_time(blobs: list, load, collect: bool) -> float:
+    if not collect:
+        gc.disable()
+    try:
+        start = time.perf_counter()
+        load(blobs)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def main(posts: int):
+    posts = catalog(posts)
+    old = [json.dumps(tree) for _, tree in posts.values()]
+    new = [Tree.from_dict(k, title, tree).dumps()
+           for k, (title, tree) in posts.items()]
+    k = next(iter(posts))
+    assert Tree.loads(k, new[0]).to_dict() == posts[k][1]
+
+    for name, blobs, load in [
+        ('json', old, lambda b: [json.loads(i) for i in b]),
+        ('Tree', new, lambda b: [Tree.loads('1', i) for i in b])
+    ]:
+        size = sum(len(i) for i in blobs)
+        gc_on = min(load_time(blobs, load, True) for _ in range(3))
+        gc_off = min(load_time(blobs, load, False) for _ in range(3))
+        tracemalloc.start()
+        loaded = load(blobs)  # noqa: F841
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del loaded
+        print(f'{name:>4}: stored {size / 1e6:.1f}MB, held {held / 1e6:.1f}MB'
+              f', load {gc_on:.3f}s ({gc_off:.3f}s with gc disabled)')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4000)
@@ -0,0 +1,13 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import utils  # noqa: E402
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = utils.open_db(str(tmp_path / 'anitsu.sqlite'))
+    yield conn
+    conn.close()
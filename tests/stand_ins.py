@@ -0,0 +1,26 @@
+""" Local aiohttp servers the tests run against """
+from aiohttp import web
+from contextlib import asynccontextmanager
+import socket
+import ssl
+
+
+@asynccontextmanager
+async def serve(routes: list, certfile=None, keyfile=None):
+    """ Serve `routes` on a free localhost port and yield its address """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    ctx = None
+    if certfile:
+        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ctx.load_cert_chain(certfile, keyfile)
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port, ssl_context=ctx).start()
+    try:
+        yield f'127.0.0.1:{port}'
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import importlib.util
+import utils
+
+spec = importlib.util.spec_from_file_location(
+    'anitsu_cli', os.path.join(os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__))), 'anitsu-cli.py'))
+cli = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cli)
+
+
+def test_prune_render_keeps_the_newest(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, 'RENDER_DIR', str(tmp_path))
+    monkeypatch.setattr(cli, 'MAX_RENDER_FILES', 2)
+    for i in range(4):
+        file = tmp_path / str(i)
+        file.write_text('')
+        os.utime(file, (i, i))
+
+    cli.prune_render()
+
+    assert sorted(i.name for i in tmp_path.iterdir()) == ['2', '3']
+
+
+def test_prune_render_without_renders(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, 'RENDER_DIR', str(tmp_path / '.render'))
+    cli.prune_render()
+
+
+def test_prerender_skips_the_line_back(monkeypatch):
+    output = ['::..', '1:0:S1', '1:0:S2', '2:0:t', '3:0:t']
+    monkeypatch.setattr(cli, 'output', output, raising=False)
+    monkeypatch.setattr(cli, 'positions', None, raising=False)
+    monkeypatch.setattr(cli, 'tasks', set(), raising=False)
+    monkeypatch.setattr(cli, 'PRERENDER', 2)
+    rendered = []
+
+    async def render(post_id):
+        rendered.append(post_id)
+    monkeypatch.setattr(cli, 'render', render)
+
+    async def main():
+        cli.prerender('1:0:S2')
+        await asyncio.gather(*cli.tasks)
+    asyncio.run(main())
+
+    assert rendered == ['2', '3']
+
+
+def test_read_pack_without_a_post_id(monkeypatch):
+    monkeypatch.setattr(utils, 'pack_index', b'')
+    assert cli.read_pack('') is None
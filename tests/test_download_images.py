@@ -0,0 +1,31 @@
+import pytest
+import download_images
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def test_interrupted_resize_leaves_no_thumbnail(tmp_path, monkeypatch):
+    src, dst = str(tmp_path / 'image'), str(tmp_path / 'thumb.jpg')
+    Image.new('RGB', (848, 1200)).save(src, 'PNG')
+    save = Image.Image.save
+
+    def interrupted(self, fp, *args, **kwargs):
+        save(self, fp, *args, **kwargs)
+        with open(fp, 'r+b') as f:
+            f.truncate(100)
+        raise KeyboardInterrupt
+    monkeypatch.setattr(Image.Image, 'save', interrupted)
+
+    with pytest.raises(KeyboardInterrupt):
+        download_images.resize(src, dst)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_resize(tmp_path):
+    src, dst = str(tmp_path / 'image'), str(tmp_path / 'thumb.jpg')
+    Image.new('RGB', (848, 1200)).save(src, 'PNG')
+
+    assert download_images.resize(src, dst)
+    with Image.open(dst) as img:
+        assert img.size == download_images.THUMB_SIZE
+    assert [i.name for i in tmp_path.iterdir()] == ['thumb.jpg']
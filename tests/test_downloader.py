@@ -0,0 +1,50 @@
+import asyncio
+import os
+from aiohttp import web
+from downloader import Downloader
+from stand_ins import serve
+
+
+def test_same_name_from_different_folders(tmp_path):
+    src, dest = tmp_path / 'src', tmp_path / 'dest'
+    for i, folder in enumerate(['S1', 'S2']):
+        os.makedirs(src / folder)
+        (src / folder / 'ep01.mkv').write_bytes(bytes([i]) * (1000 + i))
+    os.makedirs(dest)
+    (dest / 'ep01.mkv').write_bytes(b'older and unrelated')
+
+    async def handler(request):
+        return web.FileResponse(src / request.match_info['path'])
+
+    async def main():
+        async with serve([web.get('/{path:.*}', handler)]) as host, \
+                Downloader(str(dest)) as dl:
+            for folder in ['S1', 'S2']:
+                dl.add(f'http://{host}/{folder}/ep01.mkv')
+            await dl.wait()
+            return dl
+    dl = asyncio.run(main())
+
+    assert not dl.failed and len(dl.done) == 2
+    assert sorted(os.listdir(dest)) == ['ep01.1.mkv', 'ep01.2.mkv',
+                                        'ep01.mkv']
+    assert (dest / 'ep01.mkv').read_bytes() == b'older and unrelated'
+    assert sorted(os.path.getsize(i) for i in dl.done) == [1000, 1001]
+
+
+def test_missing_destination_is_created(tmp_path):
+    dest = tmp_path / 'Downloads'
+
+    async def handler(request):
+        return web.Response(body=b'x' * 100)
+
+    async def main():
+        async with serve([web.get('/ep01.mkv', handler)]) as host, \
+                Downloader(str(dest)) as dl:
+            dl.add(f'http://{host}/ep01.mkv')
+            await asyncio.wait_for(dl.wait(), 5)
+            return dl
+    dl = asyncio.run(main())
+
+    assert not dl.failed
+    assert (dest / 'ep01.mkv').read_bytes() == b'x' * 100
@@ -0,0 +1,129 @@
+import asyncio
+import subprocess as sp
+import time
+import pytest
+import utils
+import get_files
+from aiohttp import web, ClientSession, TCPConnector
+from shutil import which
+from stand_ins import serve
+from utils import save_post, get_tree, load_failed
+
+DAV = '/nextcloud/public.php/webdav/'
+SHARES = 6  # half of them on each host name of the server
+
+
+@pytest.fixture
+def cert(tmp_path):
+    """ nextcloud() only speaks https, the stand-in gets a self-signed cert """
+    if which('openssl') is None:
+        pytest.skip('openssl is needed to make a certificate')
+    certfile, keyfile = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    sp.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-subj', '/CN=localhost', '-days', '1',
+            '-keyout', keyfile, '-out', certfile],
+           check=True, capture_output=True)
+    return certfile, keyfile
+
+
+@pytest.fixture(autouse=True)
+def fast_breakers(monkeypatch):
+    monkeypatch.setattr(utils, 'limiters', dict())
+    monkeypatch.setattr(utils, 'breakers', dict())
+    monkeypatch.setattr(utils, 'BACKOFF', .01)
+    monkeypatch.setattr(utils, 'MAX_BACKOFF', .05)
+    monkeypatch.setattr(utils, 'COOLDOWN', .1)
+    monkeypatch.setattr(utils, 'MAX_COOLDOWN', .2)
+    monkeypatch.setattr(get_files, 'failures', 0)
+    monkeypatch.setattr(get_files, 'ClientSession',
+                        lambda: ClientSession(connector=TCPConnector(ssl=False)))
+
+
+class FlakyDav:
+    """ WebDAV stand-in that answers 503 for the host names in `down` until
+    their time is over, every share holds S/ep 01.mkv """
+
+    def __init__(self):
+        self.down = dict()  # host name: monotonic time it comes back
+
+    def multistatus(self, entries: list) -> web.Response:
+        body = ''.join(
+            f'<d:response><d:href>{DAV}{href}</d:href><d:propstat><d:prop>'
+            f'<d:getetag>"{href}"</d:getetag>' + (
+                f'<d:getcontentlength>{size}</d:getcontentlength>'
+                '<d:getcontenttype>video/x-matroska</d:getcontenttype>'
+                if size else '<d:resourcetype><d:collection/></d:resourcetype>'
+            ) + '</d:prop></d:propstat></d:response>'
+            for href, size in entries)
+        return web.Response(status=207, text='<?xml version="1.0"?><d:'
+                            f'multistatus xmlns:d="DAV:">{body}</d:multistatus>')
+
+    async def handle(self, request):
+        if time.monotonic() < self.down.get(request.url.host, 0):
+            return web.Response(status=503)
+        if request.headers.get('Depth') == '0':
+            return self.multistatus([('', 0)])
+        return self.multistatus([('', 0), ('S/', 0), ('S/ep%2001.mkv', 123)])
+
+
+def add_posts(conn, host: str):
+    port = host.split(':')[1]
+    for i in range(SHARES):
+        name = 'localhost' if i % 2 else '127.0.0.1'
+        save_post(conn, str(i), {'title': str(i), 'nextcloud': {
+            f'{name}:{port}/nextcloud/s/token{i}': {}}})
+
+
+def listed(conn) -> int:
+    return sum(1 for k, url in conn.execute('SELECT post_id, url FROM shares')
+               if get_tree(conn, k, url))
+
+
+def run(conn, cert, dav: FlakyDav, runs: list) -> list:
+    """ Call get_files.main() once per function of `runs`, which is given
+    the server time first, and return the shares listed after each """
+    async def main():
+        out = []
+        async with serve([web.route('PROPFIND', '/{tail:.*}', dav.handle)],
+                         *cert) as host:
+            add_posts(conn, host)
+            for before in runs:
+                before(time.monotonic())
+                await get_files.main()
+                out.append(listed(conn))
+        return out
+    return asyncio.run(main())
+
+
+def test_host_down_for_the_whole_run(conn, cert, monkeypatch):
+    monkeypatch.setattr(get_files, 'open_db', lambda: conn)
+    dav = FlakyDav()
+    failed = []
+
+    def host_down(now):
+        dav.down['localhost'] = now + 1e9
+
+    def host_back(now):
+        failed.extend(load_failed(conn))
+        dav.down.clear()
+        utils.breakers.clear()
+        get_files.failures = 0
+
+    assert run(conn, cert, dav, [host_down, host_back]) == [
+        SHARES // 2, SHARES]
+    # only the items of the host that was down failed, and they were listed
+    # by the next run
+    assert len(failed) == SHARES // 2
+    assert {url.split(':')[0] for _, url in failed} == {'localhost'}
+    assert load_failed(conn) == []
+
+
+def test_host_back_before_the_items_give_up(conn, cert, monkeypatch):
+    monkeypatch.setattr(get_files, 'open_db', lambda: conn)
+    dav = FlakyDav()
+
+    def host_down(now):
+        dav.down['localhost'] = now + .3
+
+    assert run(conn, cert, dav, [host_down]) == [SHARES]
+    assert load_failed(conn) == []
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import os
+import get_files
+from aiohttp import web, ClientSession
+from stand_ins import serve
+from utils import (save_post, get_tree, add_pending, done_pending, has_pending,
+                   load_failed, load_files, HostDown)
+
+URL = 'cloud.test/nextcloud/s/token'
+DAV = '/nextcloud/public.php/webdav/'
+
+
+def entry(path: str, etag: str, size=0) -> dict:
+    return {'href': DAV + path, 'size': size,
+            'type': 'video/x-matroska' if size else '', 'etag': etag}
+
+
+class FakeShare:
+    """ propfind() stand-in serving `files` {path: size} with folder etags
+    derived from their content, the way Nextcloud propagates them """
+
+    def __init__(self, files: dict):
+        self.files = files
+
+    def etag(self, folder: str) -> str:
+        return json.dumps(sorted(i for i in self.files
+                                 if i.startswith(folder)))
+
+    def entries(self, folder: str, depth: str) -> list:
+        out = [entry(folder, self.etag(folder))]
+        if depth == '0':
+            return out
+        seen = set()
+        for path, size in self.files.items():
+            if not path.startswith(folder):
+                continue
+            rest = path[len(folder):].split('/')
+            if depth == '1' and len(rest) > 1:
+                sub = f'{folder}{rest[0]}/'
+                if sub not in seen:
+                    seen.add(sub)
+                    out.append(entry(sub, self.etag(sub)))
+                continue
+            for i in range(1, len(rest)):
+                sub = folder + '/'.join(rest[:i]) + '/'
+                if sub not in seen:
+                    seen.add(sub)
+                    out.append(entry(sub, self.etag(sub)))
+            out.append(entry(path, 'f', size))
+        return out
+
+    async def __call__(self, url, auth, depth, callback):
+        folder = url.split('webdav', 1)[1].lstrip('/')
+        folder = f'{folder.rstrip("/")}/' if folder else ''
+        callback(self.entries(folder, depth))
+        return 207
+
+
+def names(tree: dict) -> set:
+    out = set()
+    for k, v in tree.items():
+        out.add(k.split(':', 2)[2])
+        if isinstance(v, dict):
+            out |= {f'{k.split(":", 2)[2]}/{i}' for i in names(v)}
+    return out
+
+
+def test_reuse_folder_under_folder_without_files(conn, monkeypatch):
+    save_post(conn, '1', {'title': 't', 'nextcloud': {URL: {}}})
+    monkeypatch.setattr(get_files, 'conn', conn, raising=False)
+    share = FakeShare({'Show/S1/ep01.mkv': 10, 'Show/S2/ep01.mkv': 20})
+    monkeypatch.setattr(get_files, 'propfind', share)
+
+    asyncio.run(get_files.nextcloud('1', URL))
+    share.files['Show/S2/ep02.mkv'] = 30
+    # the next walk descends into Show and S2, S1 is spliced in unchanged
+    asyncio.run(get_files.nextcloud('1', URL))
+
+    assert names(get_tree(conn, '1', URL)) == {
+        'Show', 'Show/S1', 'Show/S2', 'Show/S1/ep01.mkv',
+        'Show/S2/ep01.mkv', 'Show/S2/ep02.mkv'}
+
+
+def test_items_stop_waiting_on_a_probe_that_never_ends(conn, monkeypatch):
+    save_post(conn, '1', {'title': 't', 'url': 'u', 'nextcloud': {URL: {}}})
+    add_pending(conn, [('1', URL)])
+    monkeypatch.setattr(get_files, 'conn', conn, raising=False)
+    monkeypatch.setattr(get_files, 'PROBE_WAITS', 3)
+
+    async def handle(k, url):
+        raise HostDown('cloud.test', 0, probing=True)
+    monkeypatch.setattr(get_files, 'handle', handle)
+
+    async def main():
+        await get_files.attempt('1', URL)
+        await asyncio.wait_for(get_files.wait_parked(), 5)
+    asyncio.run(main())
+
+    assert load_failed(conn) == [('1', URL)]
+
+
+def test_single_file_share_listed_by_the_walk(conn, monkeypatch):
+    save_post(conn, '1', {'title': 't', 'nextcloud': {URL: {}}})
+    monkeypatch.setattr(get_files, 'conn', conn, raising=False)
+    monkeypatch.setattr(get_files, 'session', None, raising=False)
+    monkeypatch.setattr(get_files, 'no_infinity', {'cloud.test'})
+
+    async def propfind(url, auth, depth, callback):
+        e = entry('', 'e')
+        e['type'] = 'video/mp4'
+        callback([e])
+        return 207
+    monkeypatch.setattr(get_files, 'propfind', propfind)
+
+    class Head:
+        headers = {'content-disposition': 'attachment; filename="ep01.mp4"',
+                   'content-length': '42'}
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+    monkeypatch.setattr(get_files, 'request', lambda *a, **kw: Head())
+
+    asyncio.run(get_files.nextcloud('1', URL))
+
+    assert get_tree(conn, '1', URL) == {
+        '1:42:ep01.mp4': f'https://token:@{URL.split("/")[0]}'
+                         '/nextcloud/public.php/webdav/'}
+
+
+def test_resumed_run_with_every_item_done(conn, monkeypatch):
+    save_post(conn, '1', {'title': 't', 'nextcloud': {URL: {
+        '1:42:ep01.mkv': 'url'}}})
+    add_pending(conn, [('1', URL)])
+    done_pending(conn, '1', URL)
+    monkeypatch.setattr(get_files, 'open_db', lambda: conn)
+
+    asyncio.run(get_files.main())
+
+    assert not has_pending(conn)
+    assert load_files(conn)['1'].count[0] == 1
+
+
+def test_drive_lookup_down_does_not_stop_the_run(conn, monkeypatch):
+    drive = 'https://drive.google.com/file/d/abc/view'
+    save_post(conn, '1', {'title': 't', 'nextcloud': {URL: {}}})
+    save_post(conn, '2', {'title': 't', 'gdrive': {drive: {}}})
+    monkeypatch.setattr(get_files, 'open_db', lambda: conn)
+    monkeypatch.setattr(get_files, 'failures', 0)
+    monkeypatch.setattr(get_files, 'propfind', FakeShare({'ep01.mkv': 10}))
+
+    async def gd_get_file(file_id):
+        raise HostDown('drive.google.com', 0)
+    monkeypatch.setattr(get_files, 'gd_get_file', gd_get_file)
+
+    asyncio.run(get_files.main())
+
+    assert names(get_tree(conn, '1', URL)) == {'ep01.mkv'}
+    assert load_failed(conn) == [('2', drive)]
+
+
+def test_drive_folders_listed_by_rc_or_lsjson(conn, tmp_path, monkeypatch):
+    """ A stand-in rc server lists the folder `good` and fails on `bad`,
+    which falls back to a stand-in `rclone lsjson` on PATH """
+    folder = 'https://drive.google.com/drive/folders/{}'
+    save_post(conn, '1', {'title': 't', 'gdrive': {folder.format('good'): {}}})
+    save_post(conn, '2', {'title': 't', 'gdrive': {folder.format('bad'): {}}})
+    rclone = tmp_path / 'rclone'
+    rclone.write_text('#!/bin/sh\necho "$@" > "$0.args"\n'
+                      'echo \'[{"Path": "ep02.mkv", "Size": 20, "ID": "b"}]\'\n')
+    rclone.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setattr(get_files, 'conn', conn, raising=False)
+    monkeypatch.setattr(get_files, 'rc_url', None)
+    monkeypatch.setattr(get_files, 'session', None, raising=False)
+    monkeypatch.setattr(get_files, 'proc_lock', None, raising=False)
+    monkeypatch.setattr(get_files, 'rc_lock', None, raising=False)
+    lists = []
+
+    async def operations_list(request):
+        data = await request.json()
+        lists.append(data['fs'])
+        if 'root_folder_id=good:' not in data['fs']:
+            return web.Response(status=500, text='no such folder')
+        return web.json_response({'list': [
+            {'Path': 'S1/ep01.mkv', 'Size': 10, 'ID': 'a'}]})
+
+    async def main():
+        get_files.proc_lock = asyncio.Semaphore(1)
+        get_files.rc_lock = asyncio.Semaphore(1)
+        async with serve([web.post('/operations/list', operations_list)]) \
+                as host, ClientSession() as get_files.session:
+            monkeypatch.setattr(get_files, 'RC_URL', f'http://{host}/')
+            assert await get_files.start_rcd() is None
+            await get_files.google_drive('1', folder.format('good'))
+            await get_files.google_drive('2', folder.format('bad'))
+    asyncio.run(main())
+
+    assert len(lists) == 2
+    assert get_tree(conn, '1', folder.format('good')) == {'1:0:gdrive': {
+        '1:0:S1': {'1:10:ep01.mkv': get_files.GD_LINK.format('a')}}}
+    assert get_tree(conn, '2', folder.format('bad')) == {'2:0:gdrive': {
+        '2:20:ep02.mkv': get_files.GD_LINK.format('b')}}
+    assert '--drive-root-folder-id bad' in (tmp_path / 'rclone.args').read_text()
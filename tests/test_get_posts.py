@@ -0,0 +1,26 @@
+import asyncio
+import get_posts
+from utils import get_post
+
+
+def post(post_id: str, **kwargs) -> dict:
+    out = {'id': post_id, 'modified': '2024-01-01T00:00:00', 'title': 't',
+           'password': '', 'url': '', 'date': '', 'is_release': False,
+           'image_url': '', 'malid': '', 'anilist': '', 'nextcloud': [],
+           'gdrive': [], 'paywall': False}
+    out.update(kwargs)
+    return out
+
+
+def test_paywalled_post_does_not_end_the_page(conn, monkeypatch):
+    monkeypatch.setattr(get_posts, 'conn', conn, raising=False)
+    queue = asyncio.Queue()
+
+    asyncio.run(get_posts.update_db([
+        post('1', paywall=True),
+        post('2', nextcloud=['cloud.test/nextcloud/s/token'])], [queue]))
+
+    assert get_post(conn, '1') is not None
+    assert get_post(conn, '2')['nextcloud'] == {
+        'cloud.test/nextcloud/s/token': {}}
+    assert queue.get_nowait() == '2' and queue.empty()
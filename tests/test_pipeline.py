@@ -0,0 +1,35 @@
+import asyncio
+import pytest
+import pipeline
+
+
+def fake_posts(n: int, code=None):
+    async def main(outs=()):
+        for i in range(n):
+            for queue in outs:
+                await queue.put(str(i))
+        return code
+    return main
+
+
+async def drain(queue):
+    while await queue.get() is not None:
+        pass
+
+
+def test_failed_stage_stops_the_pipeline(monkeypatch):
+    async def stream(queue):
+        raise RuntimeError('stage failed')
+    monkeypatch.setattr(pipeline.get_posts, 'main', fake_posts(1000))
+    monkeypatch.setattr(pipeline.get_files, 'stream', stream)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(asyncio.wait_for(pipeline.main(), 5))
+
+
+def test_exit_code_of_get_posts(monkeypatch):
+    monkeypatch.setattr(pipeline.get_posts, 'main', fake_posts(1000, 1))
+    monkeypatch.setattr(pipeline.get_files, 'stream', drain)
+    monkeypatch.setattr(pipeline.download_images, 'stream', drain)
+
+    assert asyncio.run(pipeline.main(images=True)) == 1
@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+import utils
+from aiohttp import web, ClientSession
+from stand_ins import serve
+
+
+@pytest.fixture(autouse=True)
+def fresh_hosts(monkeypatch):
+    monkeypatch.setattr(utils, 'limiters', dict())
+    monkeypatch.setattr(utils, 'breakers', dict())
+    monkeypatch.setattr(utils, 'BACKOFF', .01)
+    monkeypatch.setattr(utils, 'THRESHOLD', 2)
+    monkeypatch.setattr(utils, 'COOLDOWN', .1)
+
+
+async def get(session, url, **kwargs) -> int:
+    async with utils.request(session, 'GET', url, **kwargs) as r:
+        return r.status
+
+
+def test_cancelled_probe_lets_the_next_request_probe():
+    state = {'status': 503, 'delay': 0}
+
+    async def handler(request):
+        await asyncio.sleep(state['delay'])
+        return web.Response(status=state['status'])
+
+    async def main():
+        async with serve([web.get('/', handler)]) as host, \
+                ClientSession() as session:
+            url = f'http://{host}/'
+            assert await get(session, url, retries=1) == 503  # opens it
+            with pytest.raises(utils.HostDown):
+                await get(session, url)
+
+            await asyncio.sleep(.15)
+            state.update(status=200, delay=1)
+            with pytest.raises(asyncio.TimeoutError):  # the probe
+                await asyncio.wait_for(get(session, url), .1)
+
+            state['delay'] = 0
+            assert await get(session, url) == 200
+
+    asyncio.run(main())
+
+
+def test_throttled_host_gets_fewer_requests(monkeypatch):
+    monkeypatch.setattr(utils, 'THRESHOLD', 1000)
+    state = {'inflight': 0, 'most': 0, 'throttled': 0}
+
+    async def handler(request):
+        if state['inflight'] >= 8:
+            state['throttled'] += 1
+            return web.Response(status=429, headers={'Retry-After': '0.1'})
+        state['inflight'] += 1
+        state['most'] = max(state['most'], state['inflight'])
+        await asyncio.sleep(.01)
+        state['inflight'] -= 1
+        return web.Response()
+
+    async def main():
+        async with serve([web.get('/', handler)]) as host, \
+                ClientSession() as session:
+            url = f'http://{host}/'
+            queue = asyncio.Queue()
+            for _ in range(300):
+                queue.put_nowait(url)
+
+            async def worker():
+                out = []
+                while not queue.empty():
+                    out.append(await get(session, queue.get_nowait()))
+                return out
+            done = await asyncio.gather(*[worker() for _ in range(64)])
+            return sum(done, []), utils.get_limiter(url)
+
+    statuses, limiter = asyncio.run(main())
+    assert statuses == [200] * 300
+    # halved on the first 429s and held back by Retry-After, a client
+    # that kept 64 requests in flight would be refused most of the time
+    assert state['throttled'] < 60
+    assert limiter.ssthresh < utils.MAX_INFLIGHT
+
+
+def test_retry_after_holds_every_request_to_the_host():
+    arrived = []
+
+    async def handler(request):
+        arrived.append(asyncio.get_running_loop().time())
+        if len(arrived) == 1:
+            return web.Response(status=429, headers={'Retry-After': '0.3'})
+        return web.Response()
+
+    async def main():
+        async with serve([web.get('/', handler)]) as host, \
+                ClientSession() as session:
+            url = f'http://{host}/'
+            assert await get(session, url, retries=0) == 429
+            assert await get(session, url, retries=0) == 200
+
+    asyncio.run(main())
+    assert arrived[1] - arrived[0] >= .3
+
+
+def test_retry_after_is_capped(monkeypatch):
+    monkeypatch.setattr(utils, 'MAX_BACKOFF', .2)
+    arrived = []
+
+    async def handler(request):
+        arrived.append(asyncio.get_running_loop().time())
+        if len(arrived) == 1:
+            return web.Response(status=429, headers={'Retry-After': '86400'})
+        if len(arrived) == 2:
+            return web.Response(status=503, headers={
+                'Retry-After': 'Fri, 31 Dec 9999 23:59:59 GMT'})
+        return web.Response()
+
+    async def main():
+        async with serve([web.get('/', handler)]) as host, \
+                ClientSession() as session:
+            url = f'http://{host}/'
+            assert await get(session, url, retries=0) == 429
+            assert await get(session, url) == 200
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+    assert arrived[-1] - arrived[0] < 1
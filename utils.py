@@ -1,5 +1,21 @@
 #!/usr/bin/env python3
+from aiohttp import ClientConnectionError
+from contextlib import asynccontextmanager
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from array import array
+from base64 import b64encode, b64decode
+from shutil import get_terminal_size
 import os
+import sys
+import json
+import mmap
+import time
+import random
+import struct
+import asyncio
+import sqlite3
 
 ROOT = os.path.realpath(os.path.dirname(__file__))
 HOME = os.getenv('HOME')
@@ -8,13 +24,128 @@ IMG_DIR = os.path.join(ROOT, 'images')
 DB_PATH = os.path.join(ROOT, 'db')
 DB = os.path.join(DB_PATH, 'anitsu.json')
 FILES_DB = os.path.join(DB_PATH, 'anitsu_files.json')
-BAR_SIZE = os.get_terminal_size().columns // 2 - 20
+SQLITE_DB = os.path.join(DB_PATH, 'anitsu.sqlite')
+PACK_DATA = os.path.join(IMG_DIR, 'thumbs.pack')
+PACK_INDEX = os.path.join(IMG_DIR, 'thumbs.idx')
+PACK_RECORD = struct.Struct('<QQI')  # post id, offset, length
+BAR_SIZE = get_terminal_size().columns // 2 - 20
 RED = '\033[1;31m'
 GRN = '\033[1;32m'
 YEL = '\033[1;33m'
 BLU = '\033[1;34m'
 MAG = '\033[1;35m'
 END = '\033[m'
+MAX_INFLIGHT = 64  # upper bound of in-flight requests per host
+RETRIES = 4  # attempts after the first one of a request, see request()
+BACKOFF = .5  # seconds, the upper bound of the wait doubles every attempt
+MAX_BACKOFF = 30
+RETRY_STATUS = [429, 500, 502, 503, 504]
+RETRY_ERRORS = (ClientConnectionError, asyncio.TimeoutError)
+THRESHOLD = 5  # failures in a row that open the circuit of a host
+COOLDOWN = 30  # seconds an open circuit rejects requests, doubled every time
+MAX_COOLDOWN = 300  # it opens again without a success in between
+POST_FIELDS = ['title', 'url', 'date', 'modified', 'password', 'is_release',
+               'image', 'image_url', 'malid', 'anilist']
+SHARES = ['nextcloud', 'gdrive']
+# columns added after a table was first created, the files table only holds
+# data derived from the shares so it is cleared to be generated again
+MIGRATIONS = [
+    ('files', 'size', 'INTEGER', 'DELETE FROM files'),
+    ('files', 'count', 'INTEGER', None),
+    ('files', 'version', 'INTEGER', None),
+]
+FILES_VERSION = 3  # format of files.tree, see Tree
+# created after MIGRATIONS since they can refer to migrated columns
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS files_titles ON files (version, post_id, title);
+CREATE INDEX IF NOT EXISTS local_files_dir ON local_files (dir);
+'''
+# left out of the local index, downloads still running
+PARTIAL = ('.part', '.part.json', '.part.json.tmp', '.aria2')
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posts (
+    id          TEXT PRIMARY KEY,
+    title       TEXT,
+    url         TEXT,
+    date        TEXT,
+    modified    TEXT,
+    password    TEXT,
+    is_release  INTEGER,
+    image       TEXT,
+    image_url   TEXT,
+    malid       TEXT,
+    anilist     TEXT
+);
+CREATE TABLE IF NOT EXISTS shares (
+    post_id     TEXT REFERENCES posts(id) ON DELETE CASCADE,
+    url         TEXT,
+    kind        TEXT,
+    tree        TEXT,
+    PRIMARY KEY (post_id, url)
+);
+CREATE TABLE IF NOT EXISTS etags (
+    post_id     TEXT,
+    url         TEXT,
+    path        TEXT,
+    etag        TEXT,
+    PRIMARY KEY (post_id, url, path),
+    FOREIGN KEY (post_id, url) REFERENCES shares(post_id, url)
+        ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS gd_files (
+    id          TEXT PRIMARY KEY,
+    name        TEXT,
+    size        INTEGER
+);
+CREATE TABLE IF NOT EXISTS images (
+    url             TEXT PRIMARY KEY,
+    etag            TEXT,
+    last_modified   TEXT,
+    hash            TEXT,
+    checked         TEXT
+);
+CREATE TABLE IF NOT EXISTS pack (
+    hash        TEXT PRIMARY KEY,
+    offset      INTEGER,
+    length      INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    post_id     TEXT PRIMARY KEY REFERENCES posts(id) ON DELETE CASCADE,
+    title       TEXT,
+    tree        TEXT,
+    size        INTEGER,
+    count       INTEGER,
+    version     INTEGER
+);
+CREATE TABLE IF NOT EXISTS pending (
+    post_id     TEXT,
+    url         TEXT,
+    done        INTEGER,
+    PRIMARY KEY (post_id, url),
+    FOREIGN KEY (post_id, url) REFERENCES shares(post_id, url)
+        ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS failed (
+    post_id     TEXT,
+    url         TEXT,
+    error       TEXT,
+    attempts    INTEGER,
+    PRIMARY KEY (post_id, url),
+    FOREIGN KEY (post_id, url) REFERENCES shares(post_id, url)
+        ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS local_dirs (
+    path        TEXT PRIMARY KEY,
+    mtime       INTEGER
+);
+CREATE TABLE IF NOT EXISTS local_files (
+    path        TEXT PRIMARY KEY,
+    dir         TEXT,
+    name        TEXT,
+    size        INTEGER,
+    mtime       INTEGER
+);
+'''
 
 for dir in [DB_PATH, IMG_DIR]:
     if not os.path.exists(dir):
@@ -22,10 +153,730 @@ for dir in [DB_PATH, IMG_DIR]:
 
 
 def pbar(curr: int, total: int):
-    p = curr * 100 // total
+    p = curr * 100 // total if total else 100
     block = p * BAR_SIZE // 100
     blank = BAR_SIZE - block
     print('[{}{}] {:3}%'.format(block * '#', '-' * blank, p),
           end='\r' if curr < total else '\n')
     # print('{} {:3}%'.format(block * '.', p),
     #       end='\r' if curr <= total else '\n')
+
+
+class Tree:
+    """ File tree of a post as parallel arrays in DFS pre-order.
+
+    Node 0 is the post itself and `end[i]` is one past the last node under
+    `i`, so the subtree of `i` is range(i, end[i]). Directories have no tail
+    and hold the total size and file count of their subtree. Links are split
+    at the last slash into one of the shared `bases` and a `tail`. Children
+    are stored directories first, then by name.
+
+    `fidx` lists the file nodes in order and `first[i]` is the position of
+    the first file under `i` in it, so the files of any node are the slice
+    fidx[first[i]:first[i] + count[i]]. """
+
+    __slots__ = ('post_id', 'name', 'size', 'count', 'end', 'base', 'tail',
+                 'bases', 'first', 'fidx')
+
+    def __init__(self, post_id, name, size, count, end, base, tail, bases,
+                 first, fidx):
+        self.post_id = post_id
+        self.name = name
+        self.size = size
+        self.count = count
+        self.end = end
+        self.base = base
+        self.tail = tail
+        self.bases = bases
+        self.first = first
+        self.fidx = fidx
+
+    @classmethod
+    def from_dict(cls, post_id: str, title: str, tree: dict):
+        """ Build from the nested {"id:size:name": link or dict} layout """
+        name, size, count, end, base, tail = [], [], [], [], [], []
+        bases = dict()
+
+        def add(n, s, link):
+            name.append(n)
+            size.append(s)
+            count.append(1)
+            end.append(len(name))
+            if link is None:
+                base.append(0)
+                tail.append(None)
+            else:
+                b, _, t = link.rpartition('/')
+                base.append(bases.setdefault(b + '/', len(bases)))
+                tail.append(t)
+            return len(name) - 1
+
+        def walk(n: str, d: dict):
+            i = add(n, 0, None)
+            items = sorted(((k.split(':', 2), v) for k, v in d.items()),
+                           key=lambda x: (not isinstance(x[1], dict), x[0][2]))
+            for (_, s, n), v in items:
+                j = walk(n, v) if isinstance(v, dict) else add(n, int(s), v)
+                size[i] += size[j]
+                count[i] += count[j]
+            count[i] -= 1
+            end[i] = len(name)
+            return i
+
+        walk(title, tree)
+        first, fidx = array('i'), array('i')
+        for i, t in enumerate(tail):
+            first.append(len(fidx))
+            if t is not None:
+                fidx.append(i)
+        return cls(post_id, name, array('q', size), array('i', count),
+                   array('i', end), array('i', base), tail, list(bases),
+                   first, fidx)
+
+    def to_dict(self, i=0) -> dict:
+        """ Back to the nested layout, used by export_json() """
+        return {
+            f'{self.post_id}:{0 if self.is_dir(j) else self.size[j]}:'
+            f'{self.name[j]}': self.to_dict(j) if self.is_dir(j) else
+            self.link(j) for j in self.children(i)
+        }
+
+    def dumps(self) -> str:
+        """ The numbers go in a single base64 string of little-endian int64
+        sizes followed by the int32 count, end, base, first and fidx, parsing
+        them from json lists is slower than the whole rest of the tree """
+        size = array('q', self.size)
+        nums = self.count + self.end + self.base + self.first + self.fidx
+        if sys.byteorder == 'big':
+            size.byteswap()
+            nums.byteswap()
+        nums = b64encode(size.tobytes() + nums.tobytes()).decode()
+        return json.dumps({'v': FILES_VERSION, 'name': self.name,
+                           'nums': nums, 'tail': self.tail,
+                           'bases': self.bases})
+
+    @classmethod
+    def loads(cls, post_id: str, data: str):
+        d = json.loads(data)
+        if d.get('v') != FILES_VERSION:
+            raise ValueError(f'unsupported files format: {d.get("v")}')
+        n = len(d['name'])
+        data = b64decode(d['nums'])
+        size, nums = array('q', data[:8 * n]), array('i', data[8 * n:])
+        if sys.byteorder == 'big':
+            size.byteswap()
+            nums.byteswap()
+        return cls(post_id, d['name'], size, nums[:n], nums[n:2 * n],
+                   nums[2 * n:3 * n], d['tail'], d['bases'],
+                   nums[3 * n:4 * n], nums[4 * n:])
+
+    def key(self, i: int) -> str:
+        """ fzf line of node `i` """
+        return f'{self.post_id}:{i}:{self.name[i]}'
+
+    def link(self, i: int) -> str:
+        return self.bases[self.base[i]] + self.tail[i]
+
+    def is_dir(self, i: int) -> bool:
+        return self.tail[i] is None
+
+    def children(self, i: int):
+        j = i + 1
+        while j < self.end[i]:
+            yield j
+            j = self.end[j]
+
+    def files(self, i: int) -> array:
+        """ Every file under node `i` """
+        return self.fidx[self.first[i]:self.first[i] + self.count[i]]
+
+
+class Limiter:
+    """ AIMD controller of in-flight requests to a single host.
+
+    Starts in slow start (+1 per response) until the first congestion signal,
+    then grows by 1/limit per response. 429, 5xx and connection errors halve
+    the limit, a response much slower than the best latency seen shrinks it a
+    bit, and Retry-After stops new requests until it expires. """
+
+    def __init__(self, limit=4, min_limit=1, max_limit=MAX_INFLIGHT):
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.ssthresh = max_limit
+        self.inflight = 0
+        self.latency = None
+        self.resume_at = 0
+        self.cond = None
+
+    async def acquire(self):
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+
+        async with self.cond:
+            while True:
+                wait = self.resume_at - time.monotonic()
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(self.cond.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.inflight < int(self.limit):
+                    break
+                else:
+                    await self.cond.wait()
+            self.inflight += 1
+
+    async def release(self, status: int, latency: float, retry_after=None):
+        async with self.cond:
+            self.inflight -= 1
+            self.update(status, latency, retry_after)
+            self.cond.notify_all()
+
+    def update(self, status: int, latency: float, retry_after=None):
+        if status == 0 or status == 429 or status >= 500:
+            self.limit = max(self.min_limit, self.limit / 2)
+            self.ssthresh = self.limit
+            if retry_after:
+                self.resume_at = time.monotonic() + retry_after
+            return
+
+        if self.latency is None or latency < self.latency:
+            self.latency = latency
+        else:  # let the baseline follow the host slowly
+            self.latency += (latency - self.latency) * .05
+
+        if latency > self.latency * 4:
+            self.limit = max(self.min_limit, self.limit * .9)
+            self.ssthresh = self.limit
+        elif self.limit < self.ssthresh:
+            self.limit = min(self.max_limit, self.limit + 1)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class HostDown(Exception):
+    """ Raised by request() while the circuit of a host is open, `wait` is
+    the number of seconds until it lets a request through again. `probing`
+    if it is over but the request let through has not finished yet """
+
+    def __init__(self, host: str, wait: float, probing=False):
+        super().__init__(f'{host} is down, retrying in {wait:.0f}s')
+        self.host = host
+        self.wait = wait
+        self.probing = probing
+
+
+class Breaker:
+    """ Circuit breaker of a single host.
+
+    THRESHOLD failures in a row open it and requests fail at once with
+    HostDown for a cooldown. Once it is over a single request is let through,
+    a success closes the circuit and a failure opens it again with the
+    cooldown doubled, up to MAX_COOLDOWN """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.failures = 0
+        self.cooldown = COOLDOWN
+        self.until = 0
+        self.probing = False
+
+    def check(self) -> bool:
+        """ Raise HostDown if the circuit is open, True if the caller is the
+        request let through to probe the host """
+        if self.failures < THRESHOLD:
+            return False
+        wait = self.until - time.monotonic()
+        if wait > 0:
+            raise HostDown(self.host, wait)
+        elif self.probing:
+            raise HostDown(self.host, 1, probing=True)
+        self.probing = True
+        return True
+
+    def abort(self):
+        """ The probe ended without a response (cancelled or some other
+        error), the next request probes the host again """
+        self.probing = False
+
+    def success(self):
+        self.failures = 0
+        self.cooldown = COOLDOWN
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or self.failures == THRESHOLD:
+            if self.probing:
+                self.cooldown = min(self.cooldown * 2, MAX_COOLDOWN)
+            self.probing = False
+            self.until = time.monotonic() + self.cooldown
+
+
+limiters = dict()
+breakers = dict()
+pack_index = None
+pack_data = None
+
+
+def get_limiter(url: str) -> Limiter:
+    host = urlsplit(url).hostname
+    if host not in limiters:
+        limiters[host] = Limiter()
+    return limiters[host]
+
+
+def get_breaker(url: str) -> Breaker:
+    host = urlsplit(url).hostname
+    if host not in breakers:
+        breakers[host] = Breaker(host)
+    return breakers[host]
+
+
+def backoff(attempt: int, retry_after=None) -> float:
+    """ Seconds to wait before the next attempt, a random fraction of an
+    exponential bound so clients that failed together don't retry together.
+    A Retry-After of the server is a lower bound """
+    wait = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+    return max(wait, retry_after or 0)
+
+
+def parse_retry_after(value):
+    """ Retry-After is either seconds or an HTTP date, capped at MAX_BACKOFF
+    so a server asking for hours does not hold every request to it. Hosts
+    that stay down are left to their Breaker """
+    if not value:
+        return None
+    try:
+        wait = float(value)
+    except ValueError:
+        try:
+            wait = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(MAX_BACKOFF, max(0, wait))
+
+
+@asynccontextmanager
+async def request(session, method: str, url: str, retries=RETRIES, **kwargs):
+    """ session.request() gated by the Limiter and the Breaker of the url
+    host. Connection errors, timeouts and RETRY_STATUS responses are tried
+    again `retries` times after a backoff(), only until the response is
+    handed over, a body that fails halfway is up to the caller """
+    limiter = get_limiter(url)
+    breaker = get_breaker(url)
+    for attempt in range(retries + 1):
+        probe = breaker.check()
+        try:
+            await limiter.acquire()
+        except BaseException:
+            if probe:
+                breaker.abort()
+            raise
+        start = time.monotonic()
+        latency, status, retry_after = None, 0, None
+        yielded = failed = False
+        try:
+            async with session.request(method, url, **kwargs) as r:
+                latency = time.monotonic() - start
+                status = r.status
+                retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                failed = status in RETRY_STATUS
+                if not failed:
+                    breaker.success()
+                if not failed or attempt == retries:
+                    yielded = True
+                    yield r
+                    return
+        except RETRY_ERRORS:
+            failed = True
+            if yielded or attempt == retries:
+                raise
+        finally:
+            if latency is None:
+                latency = time.monotonic() - start
+            await limiter.release(status, latency, retry_after)
+            if failed:
+                breaker.failure()
+            elif probe and not status:
+                breaker.abort()
+        await asyncio.sleep(backoff(attempt, retry_after))
+
+
+def read_pack(post_id: str):
+    """ Return the thumbnail of `post_id` from the packed store or None.
+    The index is sorted by post id and searched in place through mmap """
+    global pack_index, pack_data
+    if not post_id.isdigit():  # the records are keyed by numeric post ids
+        return None
+    if pack_index is None:
+        try:
+            with open(PACK_INDEX, 'rb') as idx, open(PACK_DATA, 'rb') as data:
+                index = mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ)
+                pack_data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+                pack_index = index
+        except (OSError, ValueError):  # missing or empty
+            return None
+
+    key = int(post_id)
+    lo, hi = 0, len(pack_index) // PACK_RECORD.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        k, offset, length = PACK_RECORD.unpack_from(
+            pack_index, mid * PACK_RECORD.size)
+        if k < key:
+            lo = mid + 1
+        elif k > key:
+            hi = mid
+        else:
+            return pack_data[offset:offset + length]
+    return None
+
+
+def open_db(path=SQLITE_DB) -> sqlite3.Connection:
+    """ Open the sqlite store, importing the old json db on first use """
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    # read through a memory map, only the pages that are used get loaded
+    conn.execute('PRAGMA mmap_size = 1073741824')
+    conn.executescript(SCHEMA)
+    for table, column, kind, sql in MIGRATIONS:
+        columns = [i[1] for i in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            with conn:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {kind}')
+                if sql:
+                    conn.execute(sql)
+    conn.executescript(INDEXES)
+    if count_posts(conn) == 0 and os.path.exists(DB):
+        print(f'importing {DB}...')
+        with open(DB, 'r') as fp:
+            db = json.load(fp)
+        with conn:
+            for k, v in db.items():
+                save_post(conn, k, v, commit=False)
+    return conn
+
+
+def count_posts(conn) -> int:
+    return conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+
+def get_post(conn, post_id: str, trees=True):
+    """ Return a post in the old json layout or None.
+    With trees=False every share is mapped to None (left untouched on save) """
+    row = conn.execute(f'SELECT {",".join(POST_FIELDS)} FROM posts WHERE id = ?',
+                       (post_id,)).fetchone()
+    if row is None:
+        return None
+
+    post = dict(zip(POST_FIELDS, row))
+    post['is_release'] = bool(post['is_release'])
+    for kind in SHARES:
+        post[kind] = dict()
+    cols = 'url, kind, tree' if trees else 'url, kind, NULL'
+    for url, kind, tree in conn.execute(
+            f'SELECT {cols} FROM shares WHERE post_id = ?', (post_id,)):
+        post[kind][url] = json.loads(tree) if tree else tree
+    return post
+
+
+def iter_posts(conn, trees=True):
+    """ Yield (post_id, post) one post at a time """
+    ids = [i for i, in conn.execute('SELECT id FROM posts ORDER BY id')]
+    for post_id in ids:
+        yield post_id, get_post(conn, post_id, trees)
+
+
+def save_post(conn, post_id: str, post: dict, commit=True):
+    """ Upsert a post and its share urls in a single transaction.
+    Shares mapped to None keep whatever tree is already stored """
+    values = [post.get(i, '') for i in POST_FIELDS]
+    urls = [url for kind in SHARES for url in post.get(kind, {})]
+    sql = [
+        (f'''INSERT INTO posts (id, {",".join(POST_FIELDS)})
+             VALUES ({",".join("?" * (len(POST_FIELDS) + 1))})
+             ON CONFLICT(id) DO UPDATE SET
+             {",".join(f"{i} = excluded.{i}" for i in POST_FIELDS)}''',
+         [post_id] + values),
+        (f'''DELETE FROM shares WHERE post_id = ?
+             AND url NOT IN ({",".join("?" * len(urls))})''',
+         [post_id] + urls)
+    ]
+    for kind in SHARES:
+        for url, tree in post.get(kind, {}).items():
+            if tree is None:
+                sql.append(('''INSERT OR IGNORE INTO shares
+                               (post_id, url, kind, tree) VALUES (?, ?, ?, ?)''',
+                            (post_id, url, kind, '{}')))
+            else:
+                sql.append(('''INSERT OR REPLACE INTO shares
+                               (post_id, url, kind, tree) VALUES (?, ?, ?, ?)''',
+                            (post_id, url, kind, json.dumps(tree))))
+
+    if not commit:
+        for i in sql:
+            conn.execute(*i)
+        return
+    with conn:
+        for i in sql:
+            conn.execute(*i)
+
+
+def get_tree(conn, post_id: str, url: str) -> dict:
+    row = conn.execute('SELECT tree FROM shares WHERE post_id = ? AND url = ?',
+                       (post_id, url)).fetchone()
+    return json.loads(row[0]) if row and row[0] else dict()
+
+
+def get_etags(conn, post_id: str, url: str) -> dict:
+    """ Return {folder path: etag} of a Nextcloud share, '' is the root """
+    return dict(conn.execute(
+        'SELECT path, etag FROM etags WHERE post_id = ? AND url = ?',
+        (post_id, url)))
+
+
+def save_tree(conn, post_id: str, url: str, tree: dict, etags=None):
+    with conn:
+        conn.execute('UPDATE shares SET tree = ? WHERE post_id = ? AND url = ?',
+                     (json.dumps(tree), post_id, url))
+        if etags is None:
+            return
+        conn.execute('DELETE FROM etags WHERE post_id = ? AND url = ?',
+                     (post_id, url))
+        conn.executemany('INSERT INTO etags VALUES (?, ?, ?, ?)',
+                         [(post_id, url, k, v) for k, v in etags.items()])
+
+
+def pending_shares(conn, post_id=None, releasing=True) -> list:
+    """ Return (post_id, url) of every share not listed yet or still releasing,
+    only the ones of `post_id` if given """
+    release = 'OR p.is_release' if releasing else ''
+    if post_id is not None:
+        return conn.execute(f'''SELECT s.post_id, s.url FROM shares s
+                                JOIN posts p ON p.id = s.post_id
+                                WHERE s.post_id = ? AND
+                                (s.tree = '{{}}' {release})''',
+                            (post_id,)).fetchall()
+    return conn.execute(f'''SELECT s.post_id, s.url FROM shares s
+                            JOIN posts p ON p.id = s.post_id
+                            WHERE s.tree = '{{}}' {release}
+                            ORDER BY s.post_id''').fetchall()
+
+
+def has_pending(conn) -> bool:
+    """ True if a get_files run was interrupted, see add_pending() """
+    return conn.execute('SELECT 1 FROM pending LIMIT 1').fetchone() is not None
+
+
+def add_pending(conn, items: list):
+    """ Record the (post_id, url) items of the get_files run in progress, the
+    table is only emptied by clear_pending() once the run is over """
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO pending VALUES (?, ?, 0)',
+                         items)
+
+
+def done_pending(conn, post_id: str, url: str):
+    with conn:
+        conn.execute('UPDATE pending SET done = 1 WHERE post_id = ? AND '
+                     'url = ?', (post_id, url))
+        conn.execute('DELETE FROM failed WHERE post_id = ? AND url = ?',
+                     (post_id, url))
+
+
+def fail_pending(conn, post_id: str, url: str, error: str):
+    """ Mark an item of the run done and keep it in the failed table, which
+    load_failed() reads in the next runs until it succeeds """
+    with conn:
+        conn.execute('UPDATE pending SET done = 1 WHERE post_id = ? AND '
+                     'url = ?', (post_id, url))
+        conn.execute('''INSERT INTO failed VALUES (?, ?, ?, 1)
+                        ON CONFLICT(post_id, url) DO UPDATE SET
+                        error = excluded.error, attempts = attempts + 1''',
+                     (post_id, url, error))
+
+
+def load_failed(conn) -> list:
+    """ Return the (post_id, url) items that failed in an earlier run """
+    return conn.execute('SELECT post_id, url FROM failed').fetchall()
+
+
+def load_pending(conn) -> list:
+    """ Return the (post_id, url) items of the run not done yet """
+    return conn.execute('SELECT post_id, url FROM pending WHERE NOT done '
+                        'ORDER BY post_id').fetchall()
+
+
+def pending_posts(conn) -> set:
+    """ Return the id of every post with an item in the run """
+    return {i for i, in conn.execute('SELECT DISTINCT post_id FROM pending')}
+
+
+def clear_pending(conn):
+    with conn:
+        conn.execute('DELETE FROM pending')
+
+
+def load_gd_files(conn) -> dict:
+    """ Return {file id: (name, size)} of every Drive file resolved so far """
+    return {i: (name, size) for i, name, size in
+            conn.execute('SELECT id, name, size FROM gd_files')}
+
+
+def save_gd_file(conn, file_id: str, name: str, size: int):
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO gd_files VALUES (?, ?, ?)',
+                     (file_id, name, size))
+
+
+def load_images(conn) -> dict:
+    """ Return {image url: (etag, last_modified, hash, checked)} """
+    return {i[0]: i[1:] for i in conn.execute('SELECT * FROM images')}
+
+
+def save_image(conn, url: str, etag: str, last_modified: str, hash: str):
+    checked = datetime.now().isoformat(timespec='seconds')
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                     (url, etag, last_modified, hash, checked))
+
+
+def load_pack(conn) -> dict:
+    """ Return {image hash: (offset, length)} of the packed store """
+    return {i[0]: i[1:] for i in conn.execute('SELECT * FROM pack')}
+
+
+def save_pack(conn, packed: dict):
+    with conn:
+        conn.execute('DELETE FROM pack')
+        conn.executemany('INSERT INTO pack VALUES (?, ?, ?)',
+                         [(k, *v) for k, v in packed.items()])
+
+
+def delete_post(conn, post_id: str):
+    with conn:
+        conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
+
+
+def save_files(conn, post_id: str, title: str, tree: Tree):
+    with conn:
+        conn.execute('''INSERT OR REPLACE INTO files
+                        (post_id, title, tree, size, count, version)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     (post_id, title, tree.dumps(), tree.size[0],
+                      tree.count[0], FILES_VERSION))
+
+
+def has_files(conn) -> bool:
+    return conn.execute('SELECT 1 FROM files WHERE version = ? LIMIT 1',
+                        (FILES_VERSION,)).fetchone() is not None
+
+
+def load_titles(conn) -> list:
+    """ Return [(post_id, title), ...] sorted by post id, read from the
+    files_titles index alone so no tree is loaded """
+    return conn.execute('SELECT post_id, title FROM files WHERE version = ? '
+                        'ORDER BY post_id', (FILES_VERSION,)).fetchall()
+
+
+def load_tree(conn, post_id: str):
+    """ Return the Tree of a post or None """
+    row = conn.execute('SELECT tree FROM files WHERE post_id = ? AND '
+                       'version = ?', (post_id, FILES_VERSION)).fetchone()
+    return Tree.loads(post_id, row[0]) if row else None
+
+
+def load_files(conn) -> dict:
+    """ Return the file tree of every post as {post_id: Tree} """
+    return {
+        k: Tree.loads(k, tree) for k, tree in conn.execute(
+            'SELECT post_id, tree FROM files WHERE version = ? '
+            'ORDER BY post_id', (FILES_VERSION,))
+    }
+
+
+def export_json(conn):
+    """ Write DB and FILES_DB in the old json format, one post at a time """
+    with open(DB, 'w') as fp:
+        fp.write('{')
+        for i, (k, post) in enumerate(iter_posts(conn)):
+            fp.write(f'{", " if i else ""}{json.dumps(k)}: {json.dumps(post)}')
+        fp.write('}')
+
+    with open(FILES_DB, 'w') as fp:
+        fp.write('{')
+        for i, (k, tree) in enumerate(conn.execute(
+                'SELECT post_id, tree FROM files WHERE version = ? '
+                'ORDER BY post_id', (FILES_VERSION,))):
+            tree = Tree.loads(k, tree)
+            key = json.dumps(f'{k}:0:{tree.name[0]}')
+            tree = json.dumps(tree.to_dict())
+            fp.write(f'{", " if i else ""}{key}: {tree}')
+        fp.write('}')
+
+
+def scan_local(conn, root=DL_DIR) -> bool:
+    """ Refresh the index of the files under `root`. A directory is listed
+    again only if its mtime changed, which it does whenever a file in it is
+    created, removed or renamed, so an unchanged tree costs one stat per
+    directory. Returns True if the index changed """
+    known = {k: v for k, v in conn.execute('SELECT * FROM local_dirs')
+             if k == root or k.startswith(root + os.sep)}
+    subdirs = dict()
+    for path in known:
+        subdirs.setdefault(os.path.dirname(path), []).append(path)
+
+    changed = False
+    seen = set()
+    stack = [root]
+    with conn:
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(path)
+            if known.get(path) == mtime:
+                stack += subdirs.get(path, [])
+                continue
+
+            changed = True
+            files = []
+            try:
+                with os.scandir(path) as it:
+                    for i in it:
+                        if i.is_dir(follow_symlinks=False):
+                            stack.append(i.path)
+                        elif i.is_file():
+                            files.append(i)
+            except OSError:
+                continue
+            names = {i.name for i in files}
+            rows = []
+            for i in files:
+                if i.name.endswith(PARTIAL) or f'{i.name}.aria2' in names:
+                    continue
+                st = i.stat()
+                rows.append((i.path, path, i.name, st.st_size,
+                             st.st_mtime_ns))
+            conn.execute('DELETE FROM local_files WHERE dir = ?', (path,))
+            conn.executemany('INSERT INTO local_files VALUES (?, ?, ?, ?, ?)',
+                             rows)
+            conn.execute('INSERT OR REPLACE INTO local_dirs VALUES (?, ?)',
+                         (path, mtime))
+
+        for path in known.keys() - seen:
+            changed = True
+            conn.execute('DELETE FROM local_files WHERE dir = ?', (path,))
+            conn.execute('DELETE FROM local_dirs WHERE path = ?', (path,))
+    return changed
+
+
+def load_local(conn) -> set:
+    """ Return {(name, size)} of the files indexed by scan_local() """
+    return set(conn.execute('SELECT name, size FROM local_files'))